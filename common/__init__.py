@@ -0,0 +1,2 @@
+__author__ = 'Jianxiang Fan'
+__email__ = 'jianxiang.fan@colorado.edu'
@@ -0,0 +1,98 @@
+__author__ = 'Jianxiang Fan'
+__email__ = 'jianxiang.fan@colorado.edu'
+
+import gzip
+import itertools
+import zlib
+
+
+def open_data(path):
+    return gzip.open(path, 'rb') if path.endswith('.gz') else open(path)
+
+
+def read_records(path, label=None):
+    """
+    Yield the (id, text, label) records of a 'id\ttext' file one line at a time, the file is gzipped
+    if its name ends with '.gz'
+
+    :param path: Data file
+    :param label: Label given to every record
+    """
+    with open_data(path) as f:
+        for line in f:
+            p = line.split('\t')
+            yield p[0], p[1], label
+
+
+def fold_of(record_id, k, seed=0):
+    """
+    Return the fold of a record among k, from a hash of its id, so that a split needs no shuffle and
+    the same record always falls in the same fold for a given seed
+
+    :param record_id: Record id
+    :param k: Number of folds
+    :param seed: Seed of the assignment
+    """
+    return (zlib.crc32(record_id, seed) & 0xffffffff) % k
+
+
+def split_records(records, k, fold, seed=0, dev=False):
+    """
+    Yield the training records of a fold, or with dev=True its dev records
+
+    :param records: Iterable of (id, text, label)
+    :param k: Number of folds
+    :param fold: Fold index
+    :param seed: Seed of the assignment
+    :param dev: Yield the dev records instead of the training ones
+    """
+    for r in records:
+        if (fold_of(r[0], k, seed) == fold) == dev:
+            yield r
+
+
+def reservoir_sample(records, n, rng):
+    """
+    Return a uniform sample of n records read in one pass, keeping only the sample in memory
+
+    :param records: Iterable of records
+    :param n: Sample size
+    :param rng: Random generator
+    """
+    sample = []
+    for i, r in enumerate(records):
+        if i < n:
+            sample.append(r)
+        else:
+            j = rng.randint(0, i)
+            if j < n:
+                sample[j] = r
+    return sample
+
+
+def chunks(iterable, size):
+    """
+    Yield lists of up to size consecutive items
+
+    :param iterable: Iterable to split
+    :param size: Chunk size
+    """
+    it = iter(iterable)
+    chunk = list(itertools.islice(it, size))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(it, size))
+
+
+def interleave(*iterables):
+    """
+    Yield the items of the iterables in turn until all of them are exhausted, e.g. to alternate the
+    records of two label files in one stream
+
+    :param iterables: Iterables to interleave
+    """
+    missing = object()
+    for items in itertools.izip_longest(*iterables, fillvalue=missing):
+        for item in items:
+            if item is not missing:
+                yield item
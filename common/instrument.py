@@ -0,0 +1,257 @@
+__author__ = 'Jianxiang Fan'
+__email__ = 'jianxiang.fan@colorado.edu'
+
+import collections
+import cProfile
+import json
+import signal
+import sys
+import timeit
+
+# Off by default: phases then only check this flag, and hot-path containers are left as they are
+enabled = False
+timer = timeit.default_timer
+phases = collections.OrderedDict()
+counters = collections.OrderedDict()
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def reset():
+    phases.clear()
+    counters.clear()
+
+
+def record(name, seconds, calls=1):
+    """
+    Add the time of calls of a phase
+
+    :param name: Phase name
+    :param seconds: Seconds spent
+    :param calls: Number of calls, e.g. the items processed in the time
+    """
+    p = phases.get(name)
+    if p is None:
+        p = phases[name] = [0, 0.0]
+    p[0] += calls
+    p[1] += seconds
+
+
+def count(name, n=1):
+    if enabled:
+        counters[name] = counters.get(name, 0) + n
+
+
+class phase(object):
+    __slots__ = ('name', 'calls', 'start')
+
+    def __init__(self, name, calls=1):
+        """
+        Time the block of a with statement as a phase when instrumentation is enabled
+
+        :param name: Phase name
+        :param calls: Number of calls the block counts for
+        """
+        self.name = name
+        self.calls = calls
+        self.start = None
+
+    def __enter__(self):
+        if enabled:
+            self.start = timer()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.start is not None:
+            record(self.name, timer() - self.start, self.calls)
+
+
+def timed(func, name):
+    """
+    Return the function itself, or when instrumentation is enabled a wrapper timing each call as a
+    phase. Per-item calls are timed this way, so that they cost nothing more when it is off.
+
+    :param func: Function to time
+    :param name: Phase name
+    """
+    if not enabled:
+        return func
+
+    def wrapper(*args, **kwargs):
+        start = timer()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            record(name, timer() - start)
+
+    return wrapper
+
+
+def counted(func, name):
+    """
+    Return the function itself, or when instrumentation is enabled a wrapper counting its calls under
+    name, e.g. for the lookups of a structure which is not a set or a dict
+
+    :param func: Function to count
+    :param name: Counter name
+    """
+    if not enabled:
+        return func
+    counters.setdefault(name, 0)
+
+    def wrapper(*args):
+        counters[name] += 1
+        return func(*args)
+
+    return wrapper
+
+
+class CountingSet(set):
+    def __contains__(self, item):
+        counters[self.name] = counters.get(self.name, 0) + 1
+        return set.__contains__(self, item)
+
+
+class CountingDict(dict):
+    def __contains__(self, key):
+        counters[self.name] = counters.get(self.name, 0) + 1
+        return dict.__contains__(self, key)
+
+    def __getitem__(self, key):
+        counters[self.name] = counters.get(self.name, 0) + 1
+        return dict.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        counters[self.name] = counters.get(self.name, 0) + 1
+        return dict.get(self, key, default)
+
+
+def counting(container, name):
+    """
+    Return the container itself, or when instrumentation is enabled a copy counting its lookups under
+    name. Hot paths thus pay for counting only when it is on.
+
+    :param container: set or dict
+    :param name: Counter name
+    """
+    if not enabled:
+        return container
+    result = (CountingSet if isinstance(container, (set, frozenset)) else CountingDict)(container)
+    result.name = name
+    counters.setdefault(name, 0)
+    return result
+
+
+def report(tool, fmt='json'):
+    """
+    Return the phases and counters as JSON, or in the Prometheus text format
+
+    :param tool: Name of the tool, a label of the Prometheus samples
+    :param fmt: 'json' or 'prometheus'
+    """
+    if fmt == 'json':
+        return json.dumps({
+            'tool': tool,
+            'phases': collections.OrderedDict(
+                (name, {'calls': calls, 'seconds': seconds, 'mean_seconds': seconds / calls if calls else 0.0})
+                for name, (calls, seconds) in phases.items()),
+            'counters': counters,
+        }, indent=2) + '\n'
+    lines = ['# HELP nlp_phase_seconds_total Seconds spent in a phase',
+             '# TYPE nlp_phase_seconds_total counter']
+    lines += ['nlp_phase_seconds_total{tool="%s",phase="%s"} %r' % (tool, name, seconds)
+              for name, (calls, seconds) in phases.items()]
+    lines += ['# HELP nlp_phase_calls_total Calls or items of a phase',
+              '# TYPE nlp_phase_calls_total counter']
+    lines += ['nlp_phase_calls_total{tool="%s",phase="%s"} %d' % (tool, name, calls)
+              for name, (calls, seconds) in phases.items()]
+    lines += ['# HELP nlp_operations_total Hot-path operations',
+              '# TYPE nlp_operations_total counter']
+    lines += ['nlp_operations_total{tool="%s",operation="%s"} %d' % (tool, name, n) for name, n in counters.items()]
+    return '\n'.join(lines) + '\n'
+
+
+class Sampler(object):
+    def __init__(self, interval=0.001):
+        """
+        Sampling profiler: a SIGPROF timer records the stack of the main thread every interval seconds
+        of CPU time. Like cProfile.Profile, it has enable, disable and dump_stats, the stacks being written
+        in the collapsed format of flame graph tools.
+
+        :param interval: Seconds of CPU time between samples
+        """
+        self.interval = interval
+        self.stacks = collections.Counter()
+
+    def sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            stack.append('%s:%s' % (frame.f_code.co_filename, frame.f_code.co_name))
+            frame = frame.f_back
+        self.stacks[';'.join(reversed(stack))] += 1
+
+    def enable(self):
+        signal.signal(signal.SIGPROF, self.sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def disable(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+    def dump_stats(self, filename):
+        with open(filename, 'w') as f:
+            for stack, n in self.stacks.most_common():
+                f.write('%s %d\n' % (stack, n))
+
+
+profiler = None
+
+
+def add_arguments(parser):
+    parser.add_argument('--metrics', metavar='FILE', help='write phase timings and operation counts, - for stderr',
+                        type=str)
+    parser.add_argument('--metrics-format', metavar='FORMAT', help='metrics format: json or prometheus',
+                        default='json', choices=['json', 'prometheus'], type=str)
+    parser.add_argument('--profile', metavar='FILE', help='write a profile of the run', type=str)
+    parser.add_argument('--profiler', metavar='NAME',
+                        help='cprofile (pstats dump) or sample (collapsed stacks) profiler for --profile',
+                        default='cprofile', choices=['cprofile', 'sample'], type=str)
+
+
+def start(args):
+    """
+    Enable instrumentation and start profiling as asked by the options of add_arguments, before the
+    instrumented objects are created
+
+    :param args: Parsed arguments
+    """
+    global profiler
+    if args.metrics:
+        enable()
+    if args.profile:
+        profiler = cProfile.Profile() if args.profiler == 'cprofile' else Sampler()
+        profiler.enable()
+
+
+def finish(args, tool):
+    """
+    Stop profiling and write the profile and the metrics asked by the options of add_arguments
+
+    :param args: Parsed arguments
+    :param tool: Name of the tool
+    """
+    global profiler
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+        profiler = None
+    if args.metrics:
+        data = report(tool, args.metrics_format)
+        if args.metrics == '-':
+            sys.stderr.write(data)
+        else:
+            with open(args.metrics, 'w') as f:
+                f.write(data)
@@ -0,0 +1,257 @@
+__author__ = 'Jianxiang Fan'
+__email__ = 'jianxiang.fan@colorado.edu'
+
+import copy
+import math
+import mmap
+import struct
+
+import numpy
+from scipy import sparse
+
+from common import instrument
+from common.dataset import chunks
+from common.tokenizer import Tokenizer
+
+model_magic = b'NBMODEL2'
+# Magic, task of the model, log prior of label 0 and 1, vocabulary size, size of the vocabulary words
+model_header = struct.Struct('<8s16s2d2q')
+
+
+class NaiveBayes(object):
+    # Task of the labels, written in the model files so that a model of another task is not loaded
+    task = ''
+
+    def __init__(self, tokenizer=None, stop_words=()):
+        """
+        Naive Bayes classifier over the word ids of a tokenizer, shared by classify.py and detect.py. The
+        word counts and the log likelihoods are 2 x V arrays indexed by word id, row 0 for label 0 and
+        row 1 for label 1.
+
+        :param tokenizer: Tokenizer shared with other classifiers, by default a new one dropping the stop words
+        :param stop_words: Stop words of the default tokenizer
+        """
+        self.tokenizer = tokenizer if tokenizer is not None else Tokenizer(stop_words)
+        self.doc_counts = {}
+        self.label_counts = numpy.zeros((2, 0), dtype=numpy.int64)
+        self.prior = {}
+        self.effective = None
+        self.vocab_size = 0
+        self.log_likelihood = None
+
+    def clear(self):
+        self.doc_counts.clear()
+        self.label_counts = numpy.zeros((2, 0), dtype=numpy.int64)
+        self.prior.clear()
+        self.effective = None
+        self.vocab_size = 0
+        self.log_likelihood = None
+
+    def fit_on_texts(self, data):
+        self.update_counts(data, 1)
+
+    def compute_likelihood(self):
+        """
+        Compute the log likelihoods of the words counted more than once, over the whole count arrays at
+        once. The other words get 0, so that they add nothing to the scores of score_matrix.
+        """
+        # Short words, numbers and stop words are already dropped by the tokenizer
+        word_counts = self.label_counts.sum(axis=0)
+        self.effective = word_counts > 1
+        self.vocab_size = numpy.count_nonzero(self.effective)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            likelihood = numpy.log((self.label_counts + 1.0) / (word_counts + self.vocab_size))
+        self.log_likelihood = numpy.where(self.effective, likelihood, 0.0)
+
+    def update_counts(self, data, delta):
+        """
+        Add delta to the counts of the documents
+
+        :param data: Iterable of (id, text, label)
+        :param delta: 1 to add the documents, -1 to remove them
+        """
+        return self.update_sequence_counts(((tid, self.tokenizer.ids(text), label) for tid, text, label in data), delta)
+
+    def update_sequence_counts(self, data, delta):
+        """
+        Add delta to the counts of the documents. The word ids of 1000 documents at a time are gathered
+        by label and counted by numpy.bincount, the count arrays growing with the tokenizer.
+        Return the sorted ids of the words whose counts changed.
+
+        :param data: Iterable of (id, word id sequence, label)
+        :param delta: 1 to add the documents, -1 to remove them
+        """
+        touched = numpy.zeros(0, dtype=bool)
+        for chunk in chunks(data, 1000):
+            ids = ([], [])
+            for tid, seq, label in chunk:
+                self.doc_counts[label] = self.doc_counts.get(label, 0) + delta
+                ids[1 if label == 1 else 0].extend(seq)
+            size = max(len(self.tokenizer.words), self.label_counts.shape[1])
+            if size > self.label_counts.shape[1]:
+                self.label_counts = numpy.hstack([self.label_counts, numpy.zeros(
+                    (2, size - self.label_counts.shape[1]), dtype=numpy.int64)])
+            if size > len(touched):
+                touched = numpy.hstack([touched, numpy.zeros(size - len(touched), dtype=bool)])
+            for i in (0, 1):
+                if ids[i]:
+                    delta_counts = numpy.bincount(ids[i], minlength=size)
+                    self.label_counts[i] += delta * delta_counts
+                    touched |= delta_counts > 0
+        return numpy.flatnonzero(touched)
+
+    def partial_fit(self, data):
+        """
+        Add labeled documents to a trained model. The prior is recomputed, but only the likelihoods of
+        the words in the documents are, unless the number of effective words changes, since it is in
+        the denominator of every likelihood.
+
+        :param data: Iterable of (id, text, label)
+        """
+        self.check_counts()
+        self.update_model(self.update_counts(data, 1))
+
+    def unlearn(self, data):
+        """
+        Remove labeled documents from a trained model, the result is the same as training without them
+
+        :param data: Iterable of (id, text, label), all of them added to the model before
+        """
+        self.check_counts()
+        self.update_model(self.update_counts(data, -1))
+
+    def check_counts(self):
+        # A model read by load has likelihoods but no counts to update
+        if self.log_likelihood is not None and not self.doc_counts:
+            raise ValueError('model loaded without counts cannot be updated')
+
+    def update_model(self, touched):
+        """
+        Recompute the prior and the likelihoods of the touched words
+
+        :param touched: Sorted ids of the words whose counts changed
+        """
+        self.compute_prior()
+        if self.log_likelihood is None:
+            self.compute_likelihood()
+            return
+        size = self.label_counts.shape[1]
+        if size > self.log_likelihood.shape[1]:
+            grow = size - self.log_likelihood.shape[1]
+            self.effective = numpy.hstack([self.effective, numpy.zeros(grow, dtype=bool)])
+            self.log_likelihood = numpy.hstack([self.log_likelihood, numpy.zeros((2, grow))])
+        counts = self.label_counts[:, touched]
+        word_counts = counts.sum(axis=0)
+        effective = word_counts > 1
+        vocab_size = self.vocab_size - numpy.count_nonzero(self.effective[touched]) + numpy.count_nonzero(effective)
+        if vocab_size != self.vocab_size:
+            self.compute_likelihood()
+            return
+        self.effective[touched] = effective
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            likelihood = numpy.log((counts + 1.0) / (word_counts + vocab_size))
+        self.log_likelihood[:, touched] = numpy.where(effective, likelihood, 0.0)
+
+    def snapshot(self):
+        """
+        Return a copy of the counts and likelihoods, which can be given to restore any number of times.
+        The tokenizer is shared, not copied: restore keeps the current one, whose word ids only grow.
+        """
+        return copy.deepcopy(dict((k, v) for k, v in self.__dict__.items() if k != 'tokenizer'))
+
+    def restore(self, state):
+        self.__dict__.update(copy.deepcopy(state))
+
+    def classify(self, text):
+        return self.classify_batch([text])[0]
+
+    def sequences_to_matrix(self, sequences):
+        """
+        Return the CSR document-term matrix of the word id sequences, whose columns are the word ids of
+        the likelihood arrays, later words are dropped
+
+        :param sequences: Iterable of word id sequences
+        """
+        size = self.log_likelihood.shape[1]
+        indptr, indices = [0], []
+        for seq in sequences:
+            indices.extend(w for w in seq if w < size)
+            indptr.append(len(indices))
+        instrument.count('vocabulary_lookups', len(indices))
+        x = sparse.csr_matrix((numpy.ones(len(indices)), indices, indptr), shape=(len(indptr) - 1, size))
+        x.sum_duplicates()
+        return x
+
+    def texts_to_matrix(self, texts):
+        return self.sequences_to_matrix(self.tokenizer.ids(text, grow=False) for text in texts)
+
+    def score_matrix(self, x):
+        """
+        Return the log posterior of label 1 minus the one of label 0 for every row of a document-term
+        matrix, computed with one sparse matrix product
+
+        :param x: Document-term matrix from sequences_to_matrix
+        """
+        scores = x.dot(self.log_likelihood.T)
+        return scores[:, 1] - scores[:, 0] + (self.prior[1] - self.prior[0])
+
+    def predict_matrix(self, x):
+        """
+        Classify every row of a document-term matrix, return a list of labels
+
+        :param x: Document-term matrix from sequences_to_matrix
+        """
+        return (self.score_matrix(x) >= 0).astype(int).tolist()
+
+    def classify_batch(self, texts):
+        return self.predict_matrix(self.texts_to_matrix(texts))
+
+    def save(self, filename):
+        """
+        Write the prior, the words with a likelihood and their likelihood array to a binary file, which
+        load memory-maps. The word counts are not saved.
+
+        :param filename: Model file
+        """
+        if self.effective is not None:
+            columns = numpy.flatnonzero(self.effective)
+        else:
+            columns = numpy.arange(self.log_likelihood.shape[1])
+        words = [self.tokenizer.words[j] for j in columns]
+        data = b'\n'.join(words)
+        with open(filename, 'wb') as f:
+            f.write(model_header.pack(model_magic, self.task.encode('ascii'), self.prior[0], self.prior[1],
+                                      len(words), len(data)))
+            # Pad the words so that the likelihood array is aligned
+            f.write(data + b'\0' * (-len(data) % 8))
+            f.write(self.log_likelihood[:, columns].astype('<f8').tobytes())
+
+    def load(self, filename):
+        """
+        Replace the model by one written by save. The likelihood array is a read-only view of the
+        memory-mapped file, so the processes loading the same file share a single copy of it. Without
+        the word counts, the loaded model can classify, but not be trained further. Raise ValueError if
+        the file is not a model of the task of this classifier.
+
+        :param filename: Model file
+        """
+        with open(filename, 'rb') as f:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if m[:len(model_magic)] != model_magic:
+            raise ValueError('%s is not a model file of this version' % filename)
+        magic, task, prior0, prior1, vocab_size, words_size = model_header.unpack_from(m, 0)
+        task = task.rstrip(b'\0').decode('ascii')
+        if task != self.task:
+            raise ValueError('%s is a %s model, not a %s one' % (filename, task or 'untyped', self.task or 'untyped'))
+        offset = model_header.size
+        words = m[offset:offset + words_size].split(b'\n') if vocab_size else []
+        offset += words_size + (-words_size % 8)
+        self.clear()
+        self.tokenizer.set_words(words)
+        self.prior[0], self.prior[1] = prior0, prior1
+        self.log_likelihood = numpy.frombuffer(m, dtype='<f8', count=2 * vocab_size,
+                                               offset=offset).reshape((2, vocab_size))
+
+    def compute_prior(self):
+        self.prior[0] = math.log(float(self.doc_counts[0]) / (self.doc_counts[0] + self.doc_counts[1]))
+        self.prior[1] = math.log(float(self.doc_counts[1]) / (self.doc_counts[0] + self.doc_counts[1]))
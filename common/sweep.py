@@ -0,0 +1,140 @@
+__author__ = 'Jianxiang Fan'
+__email__ = 'jianxiang.fan@colorado.edu'
+
+import itertools
+import math
+import sys
+
+import numpy
+from scipy import sparse
+
+from common.tokenizer import Tokenizer
+
+# Default grid, the settings of the classifiers being alpha 1, min count 2, stop words dropped and min length 2
+default_alphas = [0.1, 0.25, 0.5, 1.0, 2.0]
+default_min_counts = [1, 2, 3, 5]
+default_min_lengths = [1, 2, 3]
+
+
+def parse_values(text, type=float):
+    """
+    Return the values of a comma separated option
+
+    :param text: Option value, e.g. '0.5,1,2'
+    :param type: Type of the values
+    """
+    return [type(v) for v in text.split(',') if v.strip()]
+
+
+def sweep_tokenizer():
+    """
+    Return a tokenizer keeping the stop words and the short words, so that the filters of the grid can
+    be applied to the counts afterwards
+    """
+    return Tokenizer(min_length=1)
+
+
+def count_matrix(sequences, size=None):
+    """
+    Return the CSR document-term count matrix of word id sequences
+
+    :param sequences: Iterable of word id sequences
+    :param size: Number of columns, by default one more than the largest word id
+    """
+    indptr, indices = [0], []
+    for seq in sequences:
+        indices.extend(seq)
+        indptr.append(len(indices))
+    if size is None:
+        size = max(indices) + 1 if indices else 0
+    x = sparse.csr_matrix((numpy.ones(len(indices)), indices, indptr), shape=(len(indptr) - 1, size))
+    x.sum_duplicates()
+    return x
+
+
+class NaiveBayesSweep(object):
+    def __init__(self, words, stop_words, alphas=None, min_counts=None, min_lengths=None):
+        """
+        Evaluate the Naive Bayes classifier of classify.py and detect.py for a grid of smoothing alphas,
+        min word counts, min word lengths and with or without the stop words, from the same counts.
+
+        The likelihood of word w for label l is log((c_l(w) + alpha) / (c(w) + alpha * V)). The denominator
+        does not depend on the label, so the score of a document, the log posterior of label 1 minus the
+        one of label 0, is the prior difference plus the sum of log((c_1(w) + alpha) / (c_0(w) + alpha)) over
+        its kept words. For each fold the weights of every setting are computed by broadcasting over the
+        count arrays, and the dev documents are scored for all of them by one sparse matrix product.
+
+        :param words: Words of the word ids, from sweep_tokenizer
+        :param stop_words: Stop words
+        :param alphas: Smoothing alphas
+        :param min_counts: Min training counts of the kept words
+        :param min_lengths: Min lengths of the kept words
+        """
+        self.alphas = numpy.array(alphas or default_alphas, dtype=float)
+        if (self.alphas <= 0).any():
+            raise ValueError('smoothing alphas must be positive')
+        self.min_counts = numpy.array(min_counts or default_min_counts)
+        self.stop_options = numpy.array([True, False])
+        self.min_lengths = numpy.array(min_lengths or default_min_lengths)
+        self.lengths = numpy.array([len(w) for w in words])
+        self.stop = numpy.array([w in stop_words for w in words], dtype=bool)
+        self.settings = list(itertools.product(self.alphas.tolist(), self.min_counts.tolist(),
+                                               self.stop_options.tolist(), self.min_lengths.tolist()))
+        self.correct = numpy.zeros(len(self.settings), dtype=numpy.int64)
+        self.total = 0
+        self.skipped = 0
+
+    def weights(self, counts):
+        """
+        Return the V x S array of the word weights of the S settings
+
+        :param counts: 2 x V array of the training counts of label 0 and label 1
+        """
+        word_counts = counts.sum(axis=0)
+        # Words kept by each (min count, stop words dropped, min length): M x 2 x L x V
+        kept = ((word_counts >= self.min_counts[:, None])[:, None, None, :] &
+                ~(self.stop & self.stop_options[:, None])[None, :, None, :] &
+                (self.lengths >= self.min_lengths[:, None])[None, None, :, :])
+        alphas = self.alphas[:, None]
+        ratio = numpy.log(counts[1] + alphas) - numpy.log(counts[0] + alphas)
+        # A x M x 2 x L x V, in the order of self.settings
+        w = numpy.where(kept[None], ratio[:, None, None, None, :], 0.0)
+        return w.reshape((len(self.settings), -1)).T
+
+    def add_fold(self, x_train, y_train, x_dev, y_dev):
+        """
+        Train every setting on the training documents of a fold and count its correct dev predictions.
+        A fold whose training documents miss a label has no prior for it, so it is skipped and counted
+        in skipped. Return whether the fold was scored.
+
+        :param x_train: Document-term count matrix of the training documents
+        :param y_train: Labels of the training documents, 1 or 0
+        :param x_dev: Document-term count matrix of the dev documents
+        :param y_dev: Labels of the dev documents, 1 or 0
+        """
+        y_train, y_dev = numpy.asarray(y_train), numpy.asarray(y_dev)
+        counts = numpy.vstack([numpy.asarray(x_train[y_train == label].sum(axis=0)).ravel() for label in (0, 1)])
+        docs = [numpy.count_nonzero(y_train == label) for label in (0, 1)]
+        if not all(docs):
+            self.skipped += 1
+            return False
+        prior = math.log(float(docs[1]) / len(y_train)) - math.log(float(docs[0]) / len(y_train))
+        scores = x_dev.dot(self.weights(counts)) + prior
+        self.correct += ((scores >= 0) == (y_dev[:, None] == 1)).sum(axis=0)
+        self.total += len(y_dev)
+        return True
+
+    def results(self):
+        """
+        Return the (accuracy, alpha, min count, stop words dropped, min length) of every setting, best first
+        """
+        accuracy = self.correct / float(self.total) if self.total else self.correct * 0.0
+        return sorted(((a,) + s for a, s in zip(accuracy.tolist(), self.settings)), key=lambda r: -r[0])
+
+    def print_results(self, top=None):
+        if self.skipped:
+            sys.stderr.write('%d folds skipped, their training documents have a single label\n' % self.skipped)
+        print('rank\taccuracy\talpha\tmin_count\tstop_words\tmin_length')
+        for i, (accuracy, alpha, min_count, stop, min_length) in enumerate(self.results()[:top]):
+            print('%d\t%.6f\t%g\t%d\t%s\t%d' % (i + 1, accuracy, alpha, min_count, 'drop' if stop else 'keep',
+                                               min_length))
@@ -0,0 +1,68 @@
+__author__ = 'Jianxiang Fan'
+__email__ = 'jianxiang.fan@colorado.edu'
+
+import string
+
+from common import instrument
+
+
+def base_filter():
+    return string.punctuation + '\t\n\r'
+
+
+class Tokenizer(object):
+    def __init__(self, stop_words=(), min_length=2, filters=base_filter(), split=' '):
+        """
+        Split texts into word ids in a single pass: one translate call lowercases the text and maps the
+        filtered characters to the separator, then each word is looked up in the word index. Words shorter
+        than min_length, starting with a digit or in the stop words are dropped. Only the stop words are
+        kept in a set, so that memory does not grow with the dropped words of a corpus.
+
+        :param stop_words: Words to drop
+        :param min_length: Min length of the kept words
+        :param filters: Characters mapped to the separator
+        :param split: Separator
+        """
+        self.table = (string.maketrans if str is bytes else str.maketrans)(
+            filters + string.ascii_uppercase, split * len(filters) + string.ascii_lowercase)
+        self.split = split
+        self.min_length = min_length
+        self.word_index = instrument.counting({}, 'token_lookups')
+        self.words = []
+        self.stop_words = frozenset(stop_words)
+
+    def ids(self, text, grow=True):
+        """
+        Yield the ids of the kept words of a text
+
+        :param text: Text to tokenize
+        :param grow: Give new ids to unseen words, otherwise skip them
+        """
+        word_index = self.word_index
+        stop_words = self.stop_words
+        min_length = self.min_length
+        for w in text.translate(self.table).split(self.split):
+            i = word_index.get(w)
+            if i is None:
+                if not grow or w in stop_words or len(w) < min_length or w[0].isdigit():
+                    continue
+                i = word_index[w] = len(self.words)
+                self.words.append(w)
+            yield i
+
+    def set_words(self, words):
+        """
+        Replace the word index by the given words, word i getting id i
+
+        :param words: List of words
+        """
+        self.words = list(words)
+        self.word_index = instrument.counting(dict((w, i) for i, w in enumerate(self.words)), 'token_lookups')
+
+    def tokenize(self, text):
+        """
+        Return the kept words of a text
+
+        :param text: Text to tokenize
+        """
+        return [self.words[i] for i in self.ids(text)]
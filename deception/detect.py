@@ -1,92 +1,213 @@
 __author__ = 'Jianxiang Fan'
 __email__ = 'jianxiang.fan@colorado.edu'
 
-import math
-import string
+import multiprocessing
+import os
+import sys
 import argparse
 import random
+import time
 
 import numpy
 from sklearn import svm
 from sklearn.ensemble import AdaBoostClassifier
-from sklearn.feature_extraction.text import CountVectorizer
+from sklearn.feature_extraction.text import CountVectorizer, HashingVectorizer
 from sklearn.linear_model import SGDClassifier
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common.dataset import chunks, interleave, read_records, reservoir_sample
+from common import instrument
+from common.naive_bayes import NaiveBayes
+from common.sweep import NaiveBayesSweep, count_matrix, parse_values, sweep_tokenizer
+from common.tokenizer import Tokenizer
 
-def base_filter():
-    return string.punctuation + '\t\n\r'
 
+class Classifier(NaiveBayes):
+    task = 'deception'
 
-def text_to_sequence(text, filters=base_filter(), split=" "):
-    text = text.lower().translate(string.maketrans(filters, split * len(filters)))
-    seq = text.split(split)
-    return [_f for _f in seq if _f]
+    def __init__(self, tokenizer=None):
+        """
+        Naive Bayes deception classifier, label 1 for truthful and 0 for deceptive
 
+        :param tokenizer: Tokenizer shared with other classifiers, by default a new one dropping the stop words
+        """
+        NaiveBayes.__init__(self, tokenizer, stop_words)
 
-def load_dataset(path, label=None, k=0):
-    d = []
-    with open(path) as f:
-        for line in f:
-            if line:
-                p = line.split('\t')
-                d.append((p[0], p[1], label))
-    if k != 0:
-        random.shuffle(d)
-        dev_size = len(d) / k
-        for i in range(k):
-            yield d[:i * dev_size] + d[(i + 1) * dev_size:], d[i * dev_size:(i + 1) * dev_size]
-    else:
-        yield d
-
-
-class Classifier(object):
-    def __init__(self):
-        self.doc_counts = {}
-        self.word_counts = {}
-        self.true_counts = {}
-        self.false_counts = {}
-        self.prior = {}
-        self.true_likelihood = {}
-        self.false_likelihood = {}
-        self.effective_words = None
-
-    def clear(self):
-        self.doc_counts.clear()
-        self.word_counts.clear()
-        self.true_counts.clear()
-        self.false_counts.clear()
-
-    def fit_on_texts(self, data):
-        for tid, text, label in data:
-            self.doc_counts[label] = self.doc_counts.get(label, 0) + 1
-            for w in text_to_sequence(text):
-                self.word_counts[w] = self.word_counts.get(w, 0) + 1
-                if label == 1:
-                    self.true_counts[w] = self.true_counts.get(w, 0) + 1
-                else:
-                    self.false_counts[w] = self.false_counts.get(w, 0) + 1
-
-    def compute_likelihood(self):
-        self.effective_words = [k for k, v in self.word_counts.iteritems() if
-                                v > 1 and len(k) > 1 and not k[0].isdigit() and k not in stop_words]
-        vocab_size = len(self.effective_words)
-        for w in self.effective_words:
-            self.true_likelihood[w] = math.log(
-                float(self.true_counts.get(w, 0) + 1) / (self.word_counts.get(w, 0) + vocab_size))
-            self.false_likelihood[w] = math.log(
-                float(self.false_counts.get(w, 0) + 1) / (self.word_counts.get(w, 0) + vocab_size))
+    def fit_on_sequences(self, data):
+        self.update_sequence_counts(data, 1)
 
     def classify(self, text):
-        true_prob = self.prior[1]
-        false_prob = self.prior[0]
-        for w in text_to_sequence(text):
-            true_prob += self.true_likelihood.get(w, 0)
-            false_prob += self.false_likelihood.get(w, 0)
-        return 1 if true_prob >= false_prob else 0
+        return self.classify_sequence(self.tokenizer.ids(text, grow=False))
+
+    def classify_sequence(self, seq):
+        return self.predict_matrix(self.sequences_to_matrix([seq]))[0]
+
+
+def make_vectorizer(hash_bits=None, ngrams=1):
+    """
+    Return the vectorizer of the sklearn methods: a CountVectorizer, or with hash_bits a HashingVectorizer
+    into 2 ** hash_bits columns, which is stateless, keeps no vocabulary and can transform any stream of
+    documents without fitting
+
+    :param hash_bits: Number of bits of the hashed feature space, None to count a vocabulary
+    :param ngrams: Max length of the word n-grams
+    """
+    if hash_bits is None:
+        return CountVectorizer(ngram_range=(1, ngrams), stop_words='english')
+    return HashingVectorizer(n_features=1 << hash_bits, ngram_range=(1, ngrams), stop_words='english',
+                             alternate_sign=False, norm=None)
+
+
+def train_sgd(read_data, vectorizer, epochs=5, seed=0, chunk_size=1000):
+    """
+    Train a logistic regression out of core: the records are streamed in chunks, vectorized by a
+    stateless vectorizer and given to SGDClassifier.partial_fit, so only a chunk is in memory
 
-    def compute_prior(self):
-        self.prior[0] = math.log(float(self.doc_counts[0]) / (self.doc_counts[0] + self.doc_counts[1]))
-        self.prior[1] = math.log(float(self.doc_counts[1]) / (self.doc_counts[0] + self.doc_counts[1]))
+    :param read_data: Function returning a new iterable of (id, text, label), called for every epoch
+    :param vectorizer: Stateless vectorizer, e.g. a HashingVectorizer
+    :param epochs: Number of passes over the data
+    :param seed: Random seed
+    :param chunk_size: Number of records of a chunk
+    """
+    clf = SGDClassifier(loss='log', penalty='l2', random_state=seed)
+    for epoch in range(epochs):
+        for data in chunks(read_data(), chunk_size):
+            clf.partial_fit(vectorizer.transform([d[1] for d in data]), [d[2] for d in data], classes=[0, 1])
+    return clf
+
+
+def make_folds(labels, k, rng):
+    """
+    Yield the (train indices, dev indices) of a k-fold split. The documents of each label are shuffled
+    and split into k folds separately, the remainder always stays in training.
+
+    :param labels: Labels of the documents
+    :param k: Number of folds
+    :param rng: Random generator used to shuffle
+    """
+    groups = []
+    for label in sorted(set(labels)):
+        d = [i for i, l in enumerate(labels) if l == label]
+        rng.shuffle(d)
+        groups.append(d)
+    for i in range(k):
+        train, dev = [], []
+        for d in groups:
+            dev_size = len(d) // k
+            train += d[:i * dev_size] + d[(i + 1) * dev_size:]
+            dev += d[i * dev_size:(i + 1) * dev_size]
+        yield train, dev
+
+
+# Corpus shared with the fold workers, set before the pool is forked: (word id sequences, term matrix, labels,
+# tokenizer of the word ids)
+cv_corpus = None
+
+
+def run_fold(task):
+    """
+    Train a classifier on the train indices of the shared corpus and test it on the dev indices.
+    Return (method, repetition, fold, accuracy, seconds).
+
+    :param task: (method, repetition, fold, train indices, dev indices, random seed)
+    """
+    method, rep, fold, train, dev, seed = task
+    start = time.time()
+    sequences, x, labels, tokenizer = cv_corpus
+    if method == 'nb':
+        classifier = Classifier(tokenizer)
+        classifier.fit_on_sequences((i, sequences[i], labels[i]) for i in train)
+        classifier.compute_prior()
+        classifier.compute_likelihood()
+        predictions = classifier.predict_matrix(classifier.sequences_to_matrix(sequences[i] for i in dev))
+    else:
+        # Same features as CountVectorizer(min_df=2) fitted on the train documents: the terms in 2 of them
+        x_train = x[train]
+        columns = numpy.flatnonzero(numpy.asarray((x_train > 0).sum(axis=0)).ravel() >= 2)
+        if method == 'svm':
+            clf = svm.SVC(kernel='linear', C=.1)
+        elif method == 'lr':
+            clf = SGDClassifier(loss='log', penalty='l2', random_state=seed)
+        elif method == 'boost':
+            clf = AdaBoostClassifier(random_state=seed)
+        else:
+            raise ValueError('unknown method %s' % method)
+        clf.fit(x_train[:, columns], [labels[i] for i in train])
+        predictions = clf.predict(x[dev][:, columns])
+    error_count = sum(abs(int(p) - labels[i]) for p, i in zip(predictions, dev))
+    return method, rep, fold, 1 - float(error_count) / len(dev), time.time() - start
+
+
+def cross_validate(texts, labels, methods, k, repeat=10, seed=0, workers=1, hash_bits=None, ngrams=1):
+    """
+    Run repeat times k-fold cross validation of each method. The texts are tokenized and vectorized
+    once, folds select rows of the term matrix by index, and with more than one worker the folds run
+    in a pool of forked processes. Repetition r shuffles with random.Random(seed + r).
+    Return a dict from method to the list of (accuracy, seconds) of its folds.
+
+    :param texts: Document texts
+    :param labels: Document labels, 1 or 0
+    :param methods: Methods to evaluate
+    :param k: Number of folds
+    :param repeat: Number of repetitions
+    :param seed: Random seed
+    :param workers: Number of worker processes
+    :param hash_bits: Hash the features of the sklearn methods into 2 ** hash_bits columns
+    :param ngrams: Max length of the word n-grams of the sklearn methods
+    """
+    global cv_corpus
+    with instrument.phase('vectorize'):
+        x = make_vectorizer(hash_bits, ngrams).fit_transform(texts).tocsr()
+        tokenizer = Tokenizer(stop_words)
+        cv_corpus = ([list(tokenizer.ids(t)) for t in texts], x, labels, tokenizer)
+    tasks = []
+    for rep in range(repeat):
+        for fold, (train, dev) in enumerate(make_folds(labels, k, random.Random(seed + rep))):
+            for method in methods:
+                tasks.append((method, rep, fold, train, dev, seed + rep * k + fold))
+    with instrument.phase('folds', calls=len(tasks)):
+        if workers > 1:
+            context = (multiprocessing.get_context('fork') if hasattr(multiprocessing, 'get_context')
+                       else multiprocessing)
+            pool = context.Pool(workers)
+            try:
+                results = pool.map(run_fold, tasks)
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            results = [run_fold(task) for task in tasks]
+    cv_corpus = None
+    scores = dict((method, []) for method in methods)
+    for method, rep, fold, accuracy, seconds in sorted(results):
+        scores[method].append((accuracy, seconds))
+    return scores
+
+
+def sweep_folds(texts, labels, k, repeat=10, seed=0, alphas=None, min_counts=None, min_lengths=None):
+    """
+    Evaluate a grid of Naive Bayes settings on the folds of cross_validate. The texts are tokenized once
+    without filters, and each fold scores every setting from the same counts. Return the NaiveBayesSweep.
+
+    :param texts: Document texts
+    :param labels: Document labels, 1 or 0
+    :param k: Number of folds
+    :param repeat: Number of repetitions
+    :param seed: Random seed
+    :param alphas: Smoothing alphas
+    :param min_counts: Min training counts of the kept words
+    :param min_lengths: Min lengths of the kept words
+    """
+    with instrument.phase('vectorize'):
+        tokenizer = sweep_tokenizer()
+        x = count_matrix(tokenizer.ids(t) for t in texts)
+    sweep = NaiveBayesSweep(tokenizer.words, stop_words, alphas, min_counts, min_lengths)
+    y = numpy.array(labels)
+    with instrument.phase('sweep', calls=k * repeat):
+        for rep in range(repeat):
+            for train, dev in make_folds(labels, k, random.Random(seed + rep)):
+                sweep.add_fold(x[train], y[train], x[dev], y[dev])
+    return sweep
 
 
 stop_words = frozenset([
@@ -137,63 +258,98 @@ if __name__ == '__main__':
     parser.add_argument('--true', metavar='FILE', help='true data file', default='./data/hotelT-train.txt', type=str)
     parser.add_argument('--false', metavar='FILE', help='false data file', default='./data/hotelF-train.txt', type=str)
     parser.add_argument('--test', metavar='FILE', help='test data file', default='./data/hotelDeceptionTest.txt', type=str)
-    parser.add_argument('--method', metavar='STR', help='classifier', default='nb', type=str)
+    parser.add_argument('--method', metavar='STR', help='classifier, or comma separated classifiers with --k',
+                        default='nb', type=str)
     parser.add_argument('--k', metavar='SIZE', help='k-fold size', default=0, type=int, required=False)
+    parser.add_argument('--repeat', metavar='N', help='k-fold repetitions', default=10, type=int)
+    parser.add_argument('--seed', metavar='SEED', help='random seed of k-fold and --sample', default=0, type=int)
+    parser.add_argument('--sample', metavar='N', help='train on a random sample of N documents of each label',
+                        type=int)
+    parser.add_argument('--workers', metavar='N', help='k-fold worker processes', default=1, type=int)
+    parser.add_argument('--hash-bits', metavar='N', help='hash the features of svm, lr and boost into 2^N columns',
+                        type=int)
+    parser.add_argument('--ngrams', metavar='N', help='max word n-gram length of svm, lr and boost', default=1,
+                        type=int)
+    parser.add_argument('--epochs', metavar='N', help='passes over the data of lr without --k', default=5, type=int)
+    parser.add_argument('--model', metavar='FILE', help='load the model from a file instead of training it', type=str)
+    parser.add_argument('--save', metavar='FILE', help='save the trained model to a file', type=str)
+    parser.add_argument('--sweep', help='with --k, rank the nb accuracy of a grid of smoothing alphas and word filters',
+                        action='store_true')
+    parser.add_argument('--alphas', metavar='LIST', help='comma separated smoothing alphas of --sweep', type=str)
+    parser.add_argument('--min-counts', metavar='LIST', help='comma separated min word counts of --sweep', type=str)
+    parser.add_argument('--min-lengths', metavar='LIST', help='comma separated min word lengths of --sweep', type=str)
+    parser.add_argument('--top', metavar='N', help='print the N best settings of --sweep', type=int)
+    instrument.add_arguments(parser)
     args = parser.parse_args()
+    instrument.start(args)
+    if args.sweep and args.k < 2:
+        parser.error('--sweep needs --k')
+    if args.alphas and any(alpha <= 0 for alpha in parse_values(args.alphas)):
+        parser.error('--alphas must be positive')
+    if args.k != 0 and (args.model is not None or args.save is not None or args.sample is not None):
+        parser.error('--model, --save and --sample can not be used with --k or --sweep')
+    if args.k == 0 and args.method not in ('nb', 'lr'):
+        parser.error('only nb and lr can be trained without --k')
+    if args.k == 0 and args.method == 'lr' and args.hash_bits is None:
+        parser.error('lr without --k is trained out of core and needs --hash-bits')
 
     classifier = Classifier()
-    if args.k != 0:
-        result = []
-        for i in range(10):
-            true_set = load_dataset(args.true, label=1, k=args.k)
-            false_set = load_dataset(args.false, label=0, k=args.k)
-            for ii in range(args.k):
-                classifier.clear()
-                true_train_set, true_dev_set = true_set.next()
-                false_train_set, false_dev_set = false_set.next()
-                train_set = true_train_set + false_train_set
-                test_count, error_count = 0, 0
-                test_count = len(true_dev_set) + len(false_dev_set)
-                if args.method == 'nb':
-                    classifier.fit_on_texts(true_train_set)
-                    classifier.fit_on_texts(false_train_set)
-                    classifier.compute_prior()
-                    classifier.compute_likelihood()
-                    for mid, t, l in true_dev_set:
-                        error_count += 1 - classifier.classify(t)
-                    for mid, t, l in false_dev_set:
-                        error_count += classifier.classify(t)
-                else:
-                    vectorizer = CountVectorizer(ngram_range=(1, 1), stop_words='english', min_df=2)
-                    x_train = vectorizer.fit_transform([s[1] for s in train_set])
-                    y_train = [1] * len(true_train_set) + [0] * len(false_train_set)
-                    if args.method == 'svm':
-                        clf = svm.SVC(kernel='linear', C=.1)
-                    elif args.method == 'lr':
-                        clf = SGDClassifier(loss='log', penalty='l2')
-                    elif args.method == 'boost':
-                        clf = AdaBoostClassifier()
-                    else:
-                        exit(0)
-                    clf.fit(x_train, y_train)
-                    x_true_dev = vectorizer.transform([s[1] for s in true_dev_set])
-                    predictions = clf.predict(x_true_dev)
-                    for r in predictions:
-                        error_count += 1 - r
-                    x_false_dev = vectorizer.transform([s[1] for s in false_dev_set])
-                    predictions = clf.predict(x_false_dev)
-                    for r in predictions:
-                        error_count += r
-                result.append(1 - float(error_count) / test_count)
-        print(result, numpy.mean(result), numpy.var(result))
+    if args.sweep:
+        data = list(read_records(args.true, label=1)) + list(read_records(args.false, label=0))
+        sweep = sweep_folds([d[1] for d in data], [d[2] for d in data], args.k, repeat=args.repeat, seed=args.seed,
+                            alphas=parse_values(args.alphas) if args.alphas else None,
+                            min_counts=parse_values(args.min_counts, int) if args.min_counts else None,
+                            min_lengths=parse_values(args.min_lengths, int) if args.min_lengths else None)
+        sweep.print_results(args.top)
+    elif args.k != 0:
+        # Cross validation vectorizes the whole corpus, so it is read in memory
+        data = list(read_records(args.true, label=1)) + list(read_records(args.false, label=0))
+        methods = args.method.split(',')
+        start = time.time()
+        scores = cross_validate([d[1] for d in data], [d[2] for d in data], methods, args.k,
+                                repeat=args.repeat, seed=args.seed, workers=args.workers,
+                                hash_bits=args.hash_bits, ngrams=args.ngrams)
+        for method in methods:
+            result = [a for a, t in scores[method]]
+            print('%s\tmean %.6f\tvar %.6f\tfold %.3fs' % (method, numpy.mean(result), numpy.var(result),
+                                                         numpy.mean([t for a, t in scores[method]])))
+        print('total %.3fs' % (time.time() - start))
+    elif args.method == 'lr':
+        # Alternate the records of the two files so that every chunk has both labels
+        vectorizer = make_vectorizer(args.hash_bits, args.ngrams)
+        with instrument.phase('train'):
+            clf = train_sgd(lambda: interleave(read_records(args.true, label=1), read_records(args.false, label=0)),
+                            vectorizer, epochs=args.epochs, seed=args.seed)
+        if args.test is not None:
+            for test_set in chunks(read_records(args.test), 1000):
+                with instrument.phase('inference', calls=len(test_set)):
+                    predictions = clf.predict(vectorizer.transform([t for mid, t, l in test_set]))
+                for (mid, t, l), p in zip(test_set, predictions):
+                    print('%s\t%s' % (mid, 'T' if p == 1 else 'F'))
     else:
-        true_set = load_dataset(args.true, label=1)
-        false_set = load_dataset(args.false, label=0)
-        classifier.fit_on_texts(true_set.next())
-        classifier.fit_on_texts(false_set.next())
-        classifier.compute_prior()
-        classifier.compute_likelihood()
+        if args.model is not None:
+            with instrument.phase('model_load'):
+                classifier.load(args.model)
+        else:
+            if args.sample is not None:
+                rng = random.Random(args.seed)
+                true_set = reservoir_sample(read_records(args.true, label=1), args.sample, rng)
+                false_set = reservoir_sample(read_records(args.false, label=0), args.sample, rng)
+            else:
+                true_set = read_records(args.true, label=1)
+                false_set = read_records(args.false, label=0)
+            with instrument.phase('train'):
+                classifier.fit_on_texts(true_set)
+                classifier.fit_on_texts(false_set)
+            with instrument.phase('likelihood'):
+                classifier.compute_prior()
+                classifier.compute_likelihood()
+            if args.save is not None:
+                classifier.save(args.save)
         if args.test is not None:
-            test_set = load_dataset(args.test).next()
-            for mid, t, l in test_set:
-                print('%s\t%s' % (mid, 'T' if classifier.classify(t) == 1 else 'F'))
+            for test_set in chunks(read_records(args.test), 1000):
+                with instrument.phase('inference', calls=len(test_set)):
+                    predictions = classifier.classify_batch([t for mid, t, l in test_set])
+                for (mid, t, l), p in zip(test_set, predictions):
+                    print('%s\t%s' % (mid, 'T' if p == 1 else 'F'))
+    instrument.finish(args, 'detect')
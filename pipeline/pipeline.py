@@ -0,0 +1,309 @@
+__author__ = 'Jianxiang Fan'
+__email__ = 'jianxiang.fan@colorado.edu'
+
+import argparse
+import Queue
+import collections
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+for d in ('sentiment', 'segmentation'):
+    sys.path.insert(0, os.path.join(root, d))
+import classify
+import seg
+
+# Marks the end of the stream in the queues between stages
+end = object()
+
+# The stages of the worker pool, set before the pool is forked so workers share them copy-on-write
+worker_stages = None
+
+
+def stage_chunk(task):
+    i, chunk = task
+    start = time.time()
+    result = worker_stages[i].func(chunk)
+    return result, time.time() - start
+
+
+class Stage(object):
+    def __init__(self, name, func, processes=False):
+        """
+        A step of a pipeline, mapping a chunk (list) of records to the list of their results
+
+        :param name: Stage name
+        :param func: Function from a list of records to the list of their results
+        :param processes: Run the chunks in the worker processes of the pipeline, for CPU-heavy stages
+        """
+        self.name = name
+        self.func = func
+        self.processes = processes
+        self.items = 0
+        self.chunks = 0
+        self.busy_seconds = 0.0
+        self.depth_total = 0
+        self.depth_max = 0
+        self.finished = None
+
+    def report(self, start):
+        elapsed = (self.finished or time.time()) - start
+        return collections.OrderedDict([
+            ('items', self.items), ('chunks', self.chunks), ('busy_seconds', self.busy_seconds),
+            ('items_per_second', self.items / elapsed if elapsed > 0 else 0.0),
+            ('mean_queue_depth', float(self.depth_total) / self.chunks if self.chunks else 0.0),
+            ('max_queue_depth', self.depth_max)])
+
+
+class Pipeline(object):
+    def __init__(self, stages, workers=1, queue_size=8, chunk_size=100):
+        """
+        Stream records through stages, each of them run by a thread reading chunks of records from a
+        bounded queue and writing its results to the next one. A full queue blocks the stage writing to
+        it, so at most about (len(stages) + 1) * queue_size * chunk_size records are held at a time
+        whatever the input size. With more than one worker, the stages marked processes send their chunks
+        to a pool of forked processes, keeping up to 2 * workers chunks in flight and their order.
+
+        :param stages: List of Stage
+        :param workers: Number of worker processes
+        :param queue_size: Max number of chunks waiting before each stage and the output
+        :param chunk_size: Number of records of a chunk
+        """
+        self.stages = stages
+        self.workers = workers
+        self.queue_size = queue_size
+        self.chunk_size = chunk_size
+        self.source = Stage('read', None)
+        self.stopped = threading.Event()
+        self.error = None
+        self.start = None
+
+    def put(self, queue, item):
+        # Give up when the pipeline is stopped, instead of blocking on a queue nobody reads any more
+        while not self.stopped.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def fail(self, stage, e):
+        if self.error is None:
+            self.error = '%s: %s: %s' % (stage.name, type(e).__name__, e)
+
+    def read(self, records, output):
+        stage = self.source
+        try:
+            records = iter(records)
+            while True:
+                start = time.time()
+                chunk = []
+                for r in records:
+                    chunk.append(r)
+                    if len(chunk) == self.chunk_size:
+                        break
+                stage.busy_seconds += time.time() - start
+                if not chunk or self.error is not None:
+                    break
+                stage.items += len(chunk)
+                stage.chunks += 1
+                if not self.put(output, chunk):
+                    return
+        except Exception as e:
+            self.fail(stage, e)
+        stage.finished = time.time()
+        self.put(output, end)
+
+    def chunks(self, stage, input):
+        # Chunks of the input queue until the end, recording the queue depth the stage sees before each
+        # chunk, so that mean_queue_depth averages over its chunks only
+        while True:
+            depth = input.qsize()
+            chunk = input.get()
+            if chunk is end:
+                return
+            stage.depth_total += depth
+            stage.depth_max = max(stage.depth_max, depth)
+            stage.items += len(chunk)
+            stage.chunks += 1
+            yield chunk
+
+    def run_stage(self, i, input, output, pool):
+        stage = self.stages[i]
+        try:
+            if pool is None:
+                for chunk in self.chunks(stage, input):
+                    if self.error is not None:
+                        continue
+                    start = time.time()
+                    result = stage.func(chunk)
+                    stage.busy_seconds += time.time() - start
+                    if not self.put(output, result):
+                        return
+            else:
+                pending = collections.deque()
+                for chunk in self.chunks(stage, input):
+                    if self.error is not None:
+                        continue
+                    pending.append(pool.apply_async(stage_chunk, ((i, chunk),)))
+                    if len(pending) >= 2 * self.workers:
+                        result, seconds = pending.popleft().get()
+                        stage.busy_seconds += seconds
+                        if not self.put(output, result):
+                            return
+                while pending and self.error is None:
+                    result, seconds = pending.popleft().get()
+                    stage.busy_seconds += seconds
+                    if not self.put(output, result):
+                        return
+        except Exception as e:
+            self.fail(stage, e)
+            # Drain the input so that the stages before this one can finish
+            for _ in self.chunks(stage, input):
+                pass
+        stage.finished = time.time()
+        self.put(output, end)
+
+    def run(self, records):
+        """
+        Yield the results of the records in input order. Raise RuntimeError when a stage fails.
+
+        :param records: Iterable of input records
+        """
+        global worker_stages
+        self.start = time.time()
+        pool = None
+        if self.workers > 1 and any(stage.processes for stage in self.stages):
+            worker_stages = self.stages
+            context = (multiprocessing.get_context('fork') if hasattr(multiprocessing, 'get_context')
+                       else multiprocessing)
+            pool = context.Pool(self.workers)
+        queues = [Queue.Queue(self.queue_size) for _ in range(len(self.stages) + 1)]
+        threads = [threading.Thread(target=self.read, args=(records, queues[0]))]
+        for i, stage in enumerate(self.stages):
+            threads.append(threading.Thread(target=self.run_stage, args=(
+                i, queues[i], queues[i + 1], pool if stage.processes else None)))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            while True:
+                chunk = queues[-1].get()
+                if chunk is end:
+                    break
+                if self.error is None:
+                    for r in chunk:
+                        yield r
+            if self.error is not None:
+                raise RuntimeError(self.error)
+        finally:
+            self.stopped.set()
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            worker_stages = None
+
+    def report(self):
+        """
+        Return the records, chunks, busy seconds, throughput and input queue depth of every stage
+        """
+        return collections.OrderedDict((stage.name, stage.report(self.start))
+                                       for stage in [self.source] + self.stages)
+
+
+def sentiment_stages(segmenter, classifier, base=None, labels=('NEG', 'POS')):
+    """
+    Return the stages cleaning, segmenting, tokenizing and classifying hashtags. A record ends as
+    (text, words, label, score), the score being the log posterior ratio of label 1 to label 0.
+
+    :param segmenter: Segmenter
+    :param classifier: Trained sentiment classifier
+    :param base: Segmentation mode
+    :param labels: Names of label 0 and label 1
+    """
+
+    def clean(lines):
+        return [seg.clean_input(line) for line in lines]
+
+    def segment(texts):
+        return [(text, segmenter.match(text, base)) for text in texts]
+
+    def tokenize(records):
+        ids = classifier.tokenizer.ids
+        return [(text, words, list(ids(' '.join(words), grow=False))) for text, words in records]
+
+    def score(records):
+        scores = classifier.score_matrix(classifier.sequences_to_matrix(r[2] for r in records)).tolist()
+        return [(text, words, labels[int(s >= 0)], s) for (text, words, _), s in zip(records, scores)]
+
+    return [Stage('clean_input', clean), Stage('segment', segment, processes=True), Stage('tokenize', tokenize),
+            Stage('classify', score, processes=True)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', metavar='FILE', help='hashtags, one per line (gzipped if .gz), - for stdin',
+                        default='-', type=str)
+    parser.add_argument('--output', metavar='FILE', help='output file, - for stdout', default='-', type=str)
+    parser.add_argument('--model', metavar='FILE', help='sentiment model saved by classify.py --save',
+                        required=True, type=str)
+    parser.add_argument('--lexicon', metavar='FILE', help='lexicon file of the segmenter', required=True, type=str)
+    parser.add_argument('--limit', metavar='SIZE', help='limit size of the lexicon', default=75000, type=int)
+    parser.add_argument('--core', metavar='SIZE', help='limit size of the core lexicon', default=2000, type=int)
+    parser.add_argument('--cache', metavar='DIR', help='directory of compiled lexicon files', type=str)
+    parser.add_argument('--mode', metavar='MODE', help='segmentation mode: %s' % ', '.join(seg.base_modes),
+                        default='front', choices=seg.base_modes, type=str)
+    parser.add_argument('--sw', help='short word check', action='store_true')
+    parser.add_argument('--st', help='split combine tokens', action='store_true')
+    parser.add_argument('--memo', metavar='SIZE', help='cache up to SIZE segmentation results', type=int)
+    parser.add_argument('--workers', metavar='N', help='worker processes of the segment and classify stages',
+                        default=1, type=int)
+    parser.add_argument('--queue-size', metavar='N', help='max chunks waiting before each stage', default=8,
+                        type=int)
+    parser.add_argument('--chunk-size', metavar='N', help='records of a chunk', default=100, type=int)
+    parser.add_argument('--stats', metavar='FILE', help='write the throughput and queue depth of every stage as '
+                                                        'JSON, - for stderr', type=str)
+    args = parser.parse_args()
+
+    classifier = classify.Classifier()
+    classifier.load(args.model)
+    if args.cache:
+        lex, counts, split_words, short_words = seg.cached_lexicon(args.lexicon, args.cache, args.limit, args.core,
+                                                                   args.st, args.sw)
+    else:
+        lex, counts, split_words, short_words = seg.read_lexicon(args.lexicon, args.limit, args.st, args.sw)
+    if args.mode == 'viterbi' and counts is None:
+        parser.error('viterbi mode needs a lexicon with counts')
+    segmenter = seg.Segmenter(lex,
+                              split_words=split_words,
+                              short_words=short_words,
+                              core_lexicon=lex[:args.core],
+                              counts=counts if args.mode == 'viterbi' else None,
+                              cache=seg.MatchCache(args.memo) if args.memo else None)
+
+    pipeline = Pipeline(sentiment_stages(segmenter, classifier, args.mode), args.workers, args.queue_size,
+                        args.chunk_size)
+    input = sys.stdin if args.input == '-' else seg.gzopen(args.input, 'r')
+    output = sys.stdout if args.output == '-' else seg.gzopen(args.output, 'w')
+    try:
+        for text, words, label, score in pipeline.run(input):
+            output.write('%s\t%s\t%s\t%r\n' % (text, ' '.join(words), label, score))
+    except RuntimeError as e:
+        sys.exit('pipeline failed: %s' % e)
+    finally:
+        if input is not sys.stdin:
+            input.close()
+        if output is not sys.stdout:
+            output.close()
+    if args.stats:
+        data = json.dumps(pipeline.report(), indent=2) + '\n'
+        if args.stats == '-':
+            sys.stderr.write(data)
+        else:
+            with open(args.stats, 'w') as f:
+                f.write(data)
@@ -2,71 +2,302 @@
 
 # call from unix shell as
 # eval.py goldstandardfile.txt yoursystemoutput.txt
+# or, to compare several outputs in one pass over the gold standard
+# eval.py goldstandardfile.txt output1.txt output2.txt ... [--workers N] [--json scores.json]
 #
 
+import argparse
+import itertools
+import json
+import multiprocessing
 import sys
 
-def eval(keys, predictions):
-    """ Given a stream of gold standard word/tag pairs and a stream of system pairs. Figure out the the recall, precision and F1 """
 
+class IOBScore(object):
+    def __init__(self, gold=0, found=0, correct=0):
+        """
+        Entity counts of a sentence or a document
+
+        :param gold: Number of entities in the gold standard
+        :param found: Number of entities tagged by the system
+        :param correct: Number of tagged entities with the same span in the gold standard
+        """
+        self.gold = gold
+        self.found = found
+        self.correct = correct
+
+    def add(self, other):
+        self.gold += other.gold
+        self.found += other.found
+        self.correct += other.correct
+        return self
 
-    goldStandardEntities = findEntities(taggedData(keys))     # get the entities in the gold standard
-    systemEntities = findEntities(taggedData(predictions))    # and the entities in the system output
+    def precision(self):
+        return float(self.correct) / self.found if self.found else 0.0
 
-    numEntities = len(goldStandardEntities)                   # number of entities there should be
-    numReturned = len(systemEntities)                         # number actually tagged by system
-    numTruePositives = len(set.intersection(goldStandardEntities,systemEntities))    # number of those that were right
+    def recall(self):
+        return float(self.correct) / self.gold if self.gold else 0.0
 
-    precision = float(numTruePositives)/numReturned
-    recall = float(numTruePositives)/numEntities
-    f1 = 2 * (precision * recall)/(precision + recall)
+    def f1(self):
+        p, r = self.precision(), self.recall()
+        return 2 * p * r / (p + r) if p + r else 0.0
 
-    print numEntities, " entities in gold standard."
-    print numReturned, " total entities found."
-    print numTruePositives, " of which were correct."
-    
-    print "Precision: ", precision, "Recall: ", recall, "F1-measure: ", f1
 
-def findEntities(data):
-    """ Find all the IOB delimited entities in the data.  Return as a set of (begin, end) tuples. Data is sequence of word, tag pairs. """
+class EntityTracker(object):
+    def __init__(self):
+        """
+        Follow the IOB tags of a stream and report each entity when it ends, as a (begin, end) tuple of
+        token positions. An entity begins at B and ends before the next B or O, I without an open entity
+        is ignored.
+        """
+        self.start = None
 
-    entities = set()
+    def step(self, position, tag):
+        """
+        Read the tag of the token at position, return the entity ending before it or None
 
-    entityStart = 0
-    entityEnd = 0
-    
-    currentState = "Q0"
-    count = 0
-    
-    for word, tag in data:
-        count = count + 1
-        if currentState == "Q0":
+        :param position: Token position
+        :param tag: IOB tag
+        """
+        if self.start is None:
             if tag == 'B':
-                currentState = "Q1"
-                entityStart = count
-        elif currentState == "Q1":
-            if tag == "B":
-                entityEnd = count - 1
-                entities.add((entityStart, entityEnd))
-                entityStart = count
-            if tag == "O":
-                entityEnd = count - 1
-                entities.add((entityStart, entityEnd))
-                currentState = "Q0"
-
-    if currentState == "Q1":
-        entities.add((entityStart, count))
-
-    return entities
-
-def taggedData(file):
+                self.start = position
+            return None
+        if tag == 'B':
+            entity, self.start = (self.start, position - 1), position
+            return entity
+        if tag == 'O':
+            entity, self.start = (self.start, position - 1), None
+            return entity
+        return None
+
+    def close(self, position):
+        """
+        Return the entity still open after the token at position, or None
+
+        :param position: Position of the last token
+        """
+        entity, self.start = (self.start, position) if self.start is not None else None, None
+        return entity
+
+
+def tagged_lines(file):
+    """
+    Yield the (word, tag) pair of each line, or None for the blank lines ending sentences
+
+    :param file: Iterable of 'word tag' lines
+    """
     for line in file:
-        if line == '\n':
-            yield(['</s>', 'O'])
+        p = line.split()
+        yield (p[0], p[-1]) if p else None
+
+
+def score_streams(keys, predictions, check_words=True, errors=None):
+    """
+    Walk the gold standard and any number of system outputs in lockstep, and yield for each sentence the
+    list of the IOBScore of every system output. Only the open entity of each stream is kept, so memory
+    does not depend on the input size. A system output not aligned token by token with the gold standard
+    raises ValueError, or if errors is given, has its message stored in errors and None scores from then on.
+
+    :param keys: Iterable of gold 'word tag' lines, sentences ended by blank lines
+    :param predictions: List of iterables of system 'word tag' lines
+    :param check_words: Also check that the streams have the same words
+    :param errors: List receiving at index i the alignment error of system output i
+    """
+    n = len(predictions)
+    gold_tracker, system_trackers = EntityTracker(), [EntityTracker() for _ in range(n)]
+    alive = [True] * n
+    scores = [IOBScore() for _ in range(n)]
+    position = 0
+    tokens = 0
+    missing = object()
+    for lines in itertools.izip_longest(tagged_lines(keys), *[tagged_lines(p) for p in predictions],
+                                        fillvalue=missing):
+        gold = lines[0]
+        if gold is not missing:
+            position += 1
+            # A blank line counts as a token tagged O, as in the original evaluator
+            gold_entity = gold_tracker.step(position, 'O' if gold is None else gold[1])
+        for i in range(n):
+            system = lines[i + 1]
+            if not alive[i] or (gold is missing and system is missing):
+                continue
+            if gold is missing or system is missing or (gold is None) != (system is None) or (
+                    check_words and gold is not None and gold[0] != system[0]):
+                message = 'line %d is not aligned: gold %s, system %s' % (
+                    position + (gold is missing), 'ends' if gold is missing else repr(gold),
+                    'ends' if system is missing else repr(system))
+                if errors is None:
+                    raise ValueError(message)
+                errors[i] = message
+                alive[i] = False
+                continue
+            system_entity = system_trackers[i].step(position, 'O' if system is None else system[1])
+            score = scores[i]
+            score.gold += gold_entity is not None
+            score.found += system_entity is not None
+            score.correct += gold_entity is not None and gold_entity == system_entity
+        if gold is None:
+            yield [score if a else None for score, a in zip(scores, alive)]
+            scores = [IOBScore() for _ in range(n)]
+            tokens = 0
+        elif gold is not missing:
+            tokens += 1
+    gold_entity = gold_tracker.close(position)
+    for i in range(n):
+        system_entity = system_trackers[i].close(position)
+        score = scores[i]
+        score.gold += gold_entity is not None
+        score.found += system_entity is not None
+        score.correct += gold_entity is not None and gold_entity == system_entity
+    if tokens:
+        yield [score if a else None for score, a in zip(scores, alive)]
+
+
+def score_sentences(keys, predictions, check_words=True):
+    """
+    Yield the IOBScore of each sentence of a system output, raise ValueError when it is not aligned
+    with the gold standard
+
+    :param keys: Iterable of gold 'word tag' lines, sentences ended by blank lines
+    :param predictions: Iterable of system 'word tag' lines
+    :param check_words: Also check that both streams have the same words
+    """
+    for scores in score_streams(keys, [predictions], check_words):
+        yield scores[0]
+
+
+def score_tags(gold_tags, system_tags):
+    """
+    Return the IOBScore of a single sentence, e.g. from the loop of a tagger
+
+    :param gold_tags: Gold IOB tags of the tokens
+    :param system_tags: System IOB tags of the tokens
+    """
+    if len(gold_tags) != len(system_tags):
+        raise ValueError('%d gold tags but %d system tags' % (len(gold_tags), len(system_tags)))
+    score = IOBScore()
+    for s in score_sentences(('x %s' % t for t in gold_tags), ('x %s' % t for t in system_tags)):
+        score.add(s)
+    return score
+
+
+def eval(keys, predictions, sentences=False):
+    """ Given a stream of gold standard word/tag pairs and a stream of system pairs. Figure out the the recall, precision and F1 """
+
+    total = IOBScore()
+    for i, score in enumerate(score_sentences(keys, predictions)):
+        if sentences:
+            print('%d\t%d\t%d\t%d\t%.6f\t%.6f\t%.6f' % (i + 1, score.gold, score.found, score.correct,
+                                                         score.precision(), score.recall(), score.f1()))
+        total.add(score)
+
+    print('%d  entities in gold standard.' % total.gold)
+    print('%d  total entities found.' % total.found)
+    print('%d  of which were correct.' % total.correct)
+
+    print('Precision:  %s Recall:  %s F1-measure:  %s' % (total.precision(), total.recall(), total.f1()))
+    return total
+
+
+def eval_files(gold, predictions, check_words=True):
+    """
+    Score system output files in a single pass over the gold standard file.
+    Return the list of (IOBScore or None, alignment error or None) of the system outputs.
+
+    :param gold: Gold standard file
+    :param predictions: System output files
+    :param check_words: Also check that the files have the same words
+    """
+    totals = [IOBScore() for _ in predictions]
+    errors = [None] * len(predictions)
+    files = []
+    try:
+        with open(gold, 'rU') as keys:
+            for name in predictions:
+                files.append(open(name, 'rU'))
+            for scores in score_streams(keys, files, check_words, errors):
+                for total, score in zip(totals, scores):
+                    if score is not None:
+                        total.add(score)
+    finally:
+        for f in files:
+            f.close()
+    return [(None if error else total, error) for total, error in zip(totals, errors)]
+
+
+def eval_files_task(task):
+    return eval_files(*task)
+
+
+def eval_many(gold, predictions, workers=1, check_words=True):
+    """
+    Score system output files against a gold standard file. With more than one worker, the files are
+    split between a pool of processes, each of them reading the gold standard once for its share.
+    Return the list of (IOBScore or None, alignment error or None) of the system outputs.
+
+    :param gold: Gold standard file
+    :param predictions: System output files
+    :param workers: Number of worker processes
+    :param check_words: Also check that the files have the same words
+    """
+    workers = min(workers, len(predictions))
+    if workers <= 1:
+        return eval_files(gold, predictions, check_words)
+    groups = [predictions[i::workers] for i in range(workers)]
+    context = multiprocessing.get_context('fork') if hasattr(multiprocessing, 'get_context') else multiprocessing
+    pool = context.Pool(workers)
+    try:
+        results = pool.map(eval_files_task, [(gold, group, check_words) for group in groups])
+    finally:
+        pool.terminate()
+        pool.join()
+    merged = [None] * len(predictions)
+    for i, result in enumerate(results):
+        merged[i::workers] = result
+    return merged
+
+
+def print_table(predictions, results):
+    width = max([len('prediction')] + [len(name) for name in predictions])
+    print('%-*s  %6s  %6s  %7s  %9s  %9s  %9s' % (width, 'prediction', 'gold', 'found', 'correct', 'precision',
+                                                   'recall', 'f1'))
+    for name, (score, error) in zip(predictions, results):
+        if error:
+            print('%-*s  error: %s' % (width, name, error))
         else:
-            yield line.strip().split()
+            print('%-*s  %6d  %6d  %7d  %9.6f  %9.6f  %9.6f' % (width, name, score.gold, score.found, score.correct,
+                                                                score.precision(), score.recall(), score.f1()))
+
 
 if __name__ == "__main__":
-      keys = open(sys.argv[1], 'rU')
-      predictions = open(sys.argv[2], 'rU')
-      eval(keys, predictions)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('gold', metavar='GOLD', help='gold standard file', type=str)
+    parser.add_argument('predictions', metavar='PREDICTION', help='system output files', type=str, nargs='+')
+    parser.add_argument('--sentences', help='print sentence, gold, found, correct, P, R and F1 of each sentence '
+                                            'of a single system output', action='store_true')
+    parser.add_argument('--workers', metavar='N', help='worker processes scoring the system outputs', default=1,
+                        type=int)
+    parser.add_argument('--json', metavar='FILE', help='also write the scores as JSON', type=str)
+    args = parser.parse_args()
+    if args.sentences and (len(args.predictions) > 1 or args.json):
+        parser.error('--sentences needs a single system output and no --json')
+
+    if len(args.predictions) == 1 and args.json is None:
+        try:
+            with open(args.gold, 'rU') as keys, open(args.predictions[0], 'rU') as predictions:
+                eval(keys, predictions, args.sentences)
+        except ValueError as e:
+            sys.exit('%s: %s' % (args.predictions[0], e))
+    else:
+        results = eval_many(args.gold, args.predictions, args.workers)
+        print_table(args.predictions, results)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump([dict([('prediction', name), ('error', error)] + (
+                    [('gold', score.gold), ('found', score.found), ('correct', score.correct),
+                     ('precision', score.precision()), ('recall', score.recall()), ('f1', score.f1())]
+                    if score is not None else [])) for name, (score, error) in zip(args.predictions, results)],
+                          f, indent=2)
+        if any(error for score, error in results):
+            sys.exit(1)
@@ -1 +1,484 @@
-__author__ = 'Jianxiang Fan'__email__ = 'jianxiang.fan@colorado.edu'import collectionsimport randomimport numpytest_rate = 0.0tag_map = {    '<S>': 0,    'O': 1,    'B': 2,    'I': 3,    '<E>': 4}tag_list = ['<S>', 'O', 'B', 'I', '<E>']def load_data(path, lower=True, test=False):    with open(path) as f:        sentence = []        for line in f:            if not line.strip():                yield sentence                sentence = []            else:                p = line.split('\t')                origin_token = p[0].strip()                sentence.append((origin_token,                                 tag_map[p[1].strip()] if not test else '',                                 origin_token.lower() if lower else origin_token))        if sentence:            yield sentencedef compute_transition_matrix(transition_counts):    return transition_counts / numpy.sum(transition_counts, axis=1)[:, numpy.newaxis]def compute_observation_matrix(token_counts, tag_counts, smoothing=False):    vocab_size = len(token_counts)    result = []    token_indices = {}    unk_count = numpy.zeros(len(tag_map) - 1)    alpha = 1 if smoothing else 0    for t, c in token_counts.iteritems():        if c[0] == 1:            unk_count += c        token_indices[t] = len(result)        result.append(            [(float(n + 1 * alpha) / (tag_counts[i] + vocab_size * alpha)) if i != 0 else 0 for i, n in enumerate(c)])    token_indices['UNK'] = len(result)    result.append([(float(n + 1 * alpha) / (tag_counts[i] + vocab_size * alpha)) if i != 0 else 0 for i, n in                   enumerate(unk_count)])    return numpy.array(result), token_indicesdef viterbi(trans_prob, obser_likeli, seq):    l, n = len(seq), len(trans_prob)    v = numpy.zeros((l, n))    back = numpy.zeros((l, n), dtype='int32')    for j in range(1, n):        v[0][j] = trans_prob[0][j] * obser_likeli[seq[0]][j]    for t in range(1, l):        for j in range(1, n):            pr = [v[t - 1][i] * trans_prob[i][j] * obser_likeli[seq[t]][j] for i in range(1, n)]            k = numpy.argmax(pr)            v[t][j] = pr[k]            back[t][j] = k + 1    result = [numpy.argmax([v[l - 1][i] * trans_prob[i][n] for i in range(1, n)]) + 1]    for j in range(l - 1, 0, -1):        result.append(back[j][result[-1]])    result.reverse()    return resultdef tokens_to_indices(seq, token_indices):    result = []    for t in seq:        if t not in token_indices:            t = 'UNK'        result.append(token_indices[t])    return resultdef output(fd, pair):    for p in pair:        fd.write('%s\t%s\n' % (p[0], tag_list[p[1]]))    fd.write('\n')if __name__ == '__main__':    n = len(tag_map)    transition_count = numpy.zeros((n - 1, n))    token_counts = collections.defaultdict(lambda: numpy.zeros(n - 1))    tag_count = numpy.zeros(n - 1)    test_set = []    for p in load_data('./data/gene.train.txt'):        if random.random() > test_rate:            last_tag = tag_map['<S>']            for origin_token, tag, token in p:                transition_count[last_tag][tag] += 1                last_tag = tag                tag_count[tag] += 1                token_counts[token][0] += 1                token_counts[token][tag] += 1            transition_count[last_tag][tag_map['<E>']] += 1        else:            test_set.append(p)    a = compute_transition_matrix(transition_count)    b, token_indices = compute_observation_matrix(token_counts, tag_count)    f2 = open('output/ans.txt', 'w')    if test_rate > 0.0:        f1 = open('output/refer.txt', 'w')        for seq in test_set:            output(f1, seq)            tags = viterbi(a, b, tokens_to_indices([t[2] for t in seq], token_indices))            output(f2, zip([t[0] for t in seq], tags))        f1.close()    else:        for seq in load_data('data/HW4-test.txt', test=True):            tags = viterbi(a, b, tokens_to_indices([t[2] for t in seq], token_indices))            ans = zip([t[0] for t in seq], tags)            output(f2, ans)    f2.close()
\ No newline at end of file
+__author__ = 'Jianxiang Fan'
+__email__ = 'jianxiang.fan@colorado.edu'
+
+import argparse
+import hashlib
+import io
+import itertools
+import multiprocessing
+import os
+import random
+import string
+import sys
+from array import array
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common import instrument
+from eval import IOBScore, score_tags
+
+tag_map = {
+    '<S>': 0,
+    'O': 1,
+    'B': 2,
+    'I': 3,
+    '<E>': 4
+}
+
+tag_list = ['<S>', 'O', 'B', 'I', '<E>']
+
+# Map upper case letters to 'A', lower case letters to 'a' and digits to '0'
+shape_table = (string.maketrans if str is bytes else str.maketrans)(
+    string.ascii_uppercase + string.ascii_lowercase + string.digits, 'A' * 26 + 'a' * 26 + '0' * 10)
+
+
+def word_signature(token):
+    """
+    Return the class of a rare token: its shape with repeated characters collapsed ('IL-2' -> 'A-0',
+    'p53' -> 'a0'), plus the last 3 letters for lower case words ('kinase' -> 'a|ase').
+
+    :param token: Token in its original case
+    """
+    shape = ''.join(c for c, _ in itertools.groupby(token.translate(shape_table)))
+    if shape == 'a' and len(token) > 3:
+        return 'a|' + token[-3:]
+    return shape
+
+
+# Version of the shard count files, part of their name so that a format change recounts every shard
+shard_format = 1
+
+# Default size in bytes of the shards of sharded training
+default_shard_size = 1 << 22
+
+
+class FeatureIndex(object):
+    def __init__(self, cache_size=1 << 16):
+        """
+        Intern tokens and their signatures into integer ids, and map the tokens of a sentence to rows of
+        the observation matrix: a row per known token, then a row per signature of the tokens seen once,
+        then the 'UNK' row.
+
+        :param cache_size: Max number of tokens whose row is cached
+        """
+        self.token_indices = {}
+        self.tokens = []
+        self.token_signatures = array('l')
+        self.signature_indices = {}
+        self.signatures = []
+        self.signature_rows = None
+        self.unk_row = None
+        self.cache_size = cache_size
+        self.row_cache = instrument.counting({}, 'feature_row_lookups')
+
+    def token_id(self, origin_token, token):
+        """
+        Return the id of a training token, interning it and the signature of its first occurrence
+
+        :param origin_token: Token in its original case
+        :param token: Token as counted
+        """
+        token_id = self.token_indices.get(token)
+        if token_id is None:
+            token_id = self.add_token(token, word_signature(origin_token))
+        return token_id
+
+    def add_token(self, token, signature):
+        """
+        Return the id of a token, interning it with the given signature if it is new
+
+        :param token: Token as counted
+        :param signature: Signature of its first occurrence
+        """
+        token_id = self.token_indices.get(token)
+        if token_id is None:
+            token_id = self.token_indices[token] = len(self.tokens)
+            self.tokens.append(token)
+            signature_id = self.signature_indices.get(signature)
+            if signature_id is None:
+                signature_id = self.signature_indices[signature] = len(self.signatures)
+                self.signatures.append(signature)
+            self.token_signatures.append(signature_id)
+        return token_id
+
+    def set_rows(self, signature_rows, unk_row):
+        self.signature_rows = signature_rows
+        self.unk_row = unk_row
+        self.row_cache.clear()
+
+    def rows(self, sentence):
+        """
+        Return the observation matrix rows of the tokens of a sentence. Unknown tokens use the row of
+        their signature, or the 'UNK' row. Rows are cached by original token.
+
+        :param sentence: List of (origin token, tag, token)
+        """
+        result = []
+        for origin_token, tag, token in sentence:
+            row = self.row_cache.get(origin_token)
+            if row is None:
+                row = self.token_indices.get(token)
+                if row is None:
+                    signature_id = self.signature_indices.get(word_signature(origin_token))
+                    row = self.unk_row if signature_id is None else self.signature_rows[signature_id]
+                if len(self.row_cache) >= self.cache_size:
+                    self.row_cache.clear()
+                self.row_cache[origin_token] = row
+            result.append(row)
+        return result
+
+
+def load_data(path, lower=True, test=False):
+    with open(path) as f:
+        for sentence in read_sentences(f, lower, test):
+            yield sentence
+
+
+def read_sentences(lines, lower=True, test=False):
+    """
+    Yield the sentences of 'token<TAB>tag' lines as lists of (origin token, tag, token), a blank line
+    ending each sentence
+
+    :param lines: Iterable of lines
+    :param lower: Count the tokens in lower case
+    :param test: The lines have no tags
+    """
+    sentence = []
+    for line in lines:
+        if not line.strip():
+            yield sentence
+            sentence = []
+        else:
+            p = line.split('\t')
+            origin_token = p[0].strip()
+            sentence.append((origin_token,
+                             tag_map[p[1].strip()] if not test else '',
+                             origin_token.lower() if lower else origin_token))
+    if sentence:
+        yield sentence
+
+
+def split_data(sentences, test_rate, seed, test=False):
+    """
+    Yield the training (or with test=True, the held-out) sentences of a random split. The split only
+    depends on the seed, so the same file can be streamed again to get the other part.
+
+    :param sentences: Iterable of sentences
+    :param test_rate: Rate of held-out sentences
+    :param seed: Random seed of the split
+    :param test: Yield the held-out sentences instead of the training ones
+    """
+    rng = random.Random(seed)
+    for sentence in sentences:
+        if (rng.random() <= test_rate) == test:
+            yield sentence
+
+
+def count_tags(sentences, flush_size=1 << 20):
+    """
+    Count tag transitions and token emissions of the tagged sentences. Token ids and tags are buffered
+    in arrays and added to the count tables by numpy.bincount every flush_size tokens.
+    Return (transition counts, token counts, tag counts, features), where features is the FeatureIndex
+    of the token ids and column 0 of the token counts holds the total count of each token.
+
+    :param sentences: Iterable of tagged sentences
+    :param flush_size: Number of tokens buffered before counting
+    """
+    n = len(tag_map)
+    features = FeatureIndex()
+    transition_count = numpy.zeros(((n - 1) * n), dtype=numpy.int64)
+    token_counts = numpy.zeros((0, n - 1), dtype=numpy.int64)
+    token_ids, tags, transitions = array('l'), array('l'), array('l')
+    for p in sentences:
+        last_tag = tag_map['<S>']
+        for origin_token, tag, token in p:
+            token_ids.append(features.token_id(origin_token, token))
+            tags.append(tag)
+            transitions.append(last_tag * n + tag)
+            last_tag = tag
+        transitions.append(last_tag * n + tag_map['<E>'])
+        if len(tags) >= flush_size or len(transitions) >= flush_size:
+            token_counts = add_counts(token_counts, len(features.tokens), token_ids, tags)
+            transition_count += numpy.bincount(transitions, minlength=(n - 1) * n)
+            token_ids, tags, transitions = array('l'), array('l'), array('l')
+    token_counts = add_counts(token_counts, len(features.tokens), token_ids, tags)
+    transition_count += numpy.bincount(transitions, minlength=(n - 1) * n)
+    token_counts[:, 0] = token_counts[:, 1:].sum(axis=1)
+    tag_count = token_counts.sum(axis=0)
+    tag_count[0] = 0
+    return transition_count.reshape((n - 1, n)), token_counts, tag_count, features
+
+
+def add_counts(token_counts, vocab_size, token_ids, tags):
+    m = token_counts.shape[1]
+    if vocab_size > len(token_counts):
+        token_counts = numpy.vstack([token_counts,
+                                     numpy.zeros((vocab_size - len(token_counts), m), dtype=numpy.int64)])
+    if token_ids:
+        token_counts += numpy.bincount(numpy.frombuffer(token_ids, dtype=numpy.dtype(token_ids.typecode)) * m +
+                                       numpy.frombuffer(tags, dtype=numpy.dtype(tags.typecode)),
+                                       minlength=vocab_size * m).reshape((vocab_size, m))
+    return token_counts
+
+
+def shard_ranges(path, shard_size=default_shard_size):
+    """
+    Return the (start, end) byte ranges splitting a training file into shards of about shard_size bytes,
+    each of them ending after a blank line. A boundary only depends on the bytes before it, so after
+    appending sentences to the file only its last shards change.
+
+    :param path: Training data file
+    :param shard_size: Min size of a shard in bytes, except the last one
+    """
+    ranges = []
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        start = 0
+        while start < size:
+            # Skip the rest of the line at start + shard_size, then end after the next blank line
+            f.seek(start + shard_size)
+            f.readline()
+            for line in iter(f.readline, b''):
+                if not line.strip():
+                    break
+            end = min(f.tell(), size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def shard_tables(transition_count, token_counts, features):
+    """
+    Return the count tables of a shard from count_tags as compact arrays: the tokens and the signatures
+    joined by newlines, the signature id of each token, its O/B/I counts and the transition counts.
+
+    :param transition_count: Transition counts from count_tags
+    :param token_counts: Token counts from count_tags
+    :param features: FeatureIndex from count_tags
+    """
+    return {'tokens': numpy.array('\n'.join(features.tokens)),
+            'signatures': numpy.array('\n'.join(features.signatures)),
+            'token_signatures': numpy.array(features.token_signatures, dtype=numpy.int32),
+            'token_counts': token_counts[:, 1:].astype(numpy.int32),
+            'transition_counts': transition_count.astype(numpy.int32)}
+
+
+def count_shard(task):
+    """
+    Count the sentences of a byte range of a training file. With a cache directory, the tables are
+    stored in it under the sha1 of the bytes, and a range already counted is only loaded.
+    Return (tables from shard_tables, True if the range was counted, False if it was loaded).
+
+    :param task: (training data file, start offset, end offset, cache directory or None)
+    """
+    path, start, end, cache_dir = task
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    cached = None
+    if cache_dir is not None:
+        cached = os.path.join(cache_dir, 'shard-%d-%s.npz' % (shard_format, hashlib.sha1(data).hexdigest()))
+        if os.path.exists(cached):
+            with open(cached, 'rb') as f:
+                npz = numpy.load(f)
+                return dict((name, npz[name]) for name in npz.files), False
+    transition_count, token_counts, tag_count, features = count_tags(read_sentences(io.BytesIO(data)))
+    tables = shard_tables(transition_count, token_counts, features)
+    if cached is not None:
+        # Write then rename, so that a concurrent or interrupted run never reads a partial file
+        temp = '%s.%d.tmp' % (cached, os.getpid())
+        with open(temp, 'wb') as f:
+            numpy.savez(f, **tables)
+        os.rename(temp, cached)
+    return tables, True
+
+
+def merge_shards(shards):
+    """
+    Add up the tables of shards in file order into the tables of count_tags. A token gets its id and
+    signature at its first shard, so the result is the same as counting the concatenated shards.
+    Return (transition counts, token counts, tag counts, features) as count_tags does.
+
+    :param shards: Iterable of tables from count_shard
+    """
+    n = len(tag_map)
+    features = FeatureIndex()
+    transition_count = numpy.zeros((n - 1, n), dtype=numpy.int64)
+    token_counts = numpy.zeros((0, n - 1), dtype=numpy.int64)
+    for tables in shards:
+        tokens = tables['tokens'].item()
+        tokens = tokens.split('\n') if tokens else []
+        signatures = tables['signatures'].item().split('\n')
+        ids = numpy.array([features.add_token(token, signatures[s])
+                           for token, s in zip(tokens, tables['token_signatures'].tolist())], dtype=numpy.intp)
+        if len(features.tokens) > len(token_counts):
+            token_counts = numpy.vstack([token_counts, numpy.zeros((len(features.tokens) - len(token_counts), n - 1),
+                                                                   dtype=numpy.int64)])
+        # The ids of a shard are distinct, so the fancy-indexed add does not lose counts
+        token_counts[ids, 1:] += tables['token_counts']
+        transition_count += tables['transition_counts']
+    token_counts[:, 0] = token_counts[:, 1:].sum(axis=1)
+    tag_count = token_counts.sum(axis=0)
+    tag_count[0] = 0
+    return transition_count, token_counts, tag_count, features
+
+
+def count_sharded(paths, shard_size=default_shard_size, workers=1, cache_dir=None):
+    """
+    Count training files as count_tags does, map-reduce style: the files are split into shards on
+    sentence boundaries, a pool of forked processes counts the shards and the counts are merged in
+    file order as they arrive. Return (count_tags tables, number of shards counted, number loaded).
+
+    :param paths: Training data files
+    :param shard_size: Size of the shards in bytes
+    :param workers: Number of worker processes
+    :param cache_dir: Directory of the shard count files, None not to keep them
+    """
+    if cache_dir is not None and not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    tasks = [(path, start, end, cache_dir) for path in paths for start, end in shard_ranges(path, shard_size)]
+    stats = [0, 0]
+
+    def tables(results):
+        for result, counted in results:
+            stats[0 if counted else 1] += 1
+            yield result
+
+    if workers > 1 and len(tasks) > 1:
+        context = multiprocessing.get_context('fork') if hasattr(multiprocessing, 'get_context') else multiprocessing
+        pool = context.Pool(min(workers, len(tasks)))
+        try:
+            merged = merge_shards(tables(pool.imap(count_shard, tasks)))
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        merged = merge_shards(tables(count_shard(task) for task in tasks))
+    return merged, stats[0], stats[1]
+
+
+def compute_transition_matrix(transition_counts):
+    return transition_counts / numpy.sum(transition_counts, axis=1)[:, numpy.newaxis].astype(float)
+
+
+def compute_observation_matrix(token_counts, tag_counts, features, smoothing=False):
+    """
+    Compute the emission probabilities: a row per token id, a row per signature estimated from the
+    tokens seen once with that signature, and a last 'UNK' row estimated from all the tokens seen once.
+    The signature rows and the 'UNK' row are registered in features.
+
+    :param token_counts: Token counts from count_tags
+    :param tag_counts: Tag counts from count_tags
+    :param features: FeatureIndex from count_tags
+    :param smoothing: Use add-one smoothing
+    """
+    vocab_size = len(features.tokens)
+    alpha = 1 if smoothing else 0
+    rare = token_counts[:, 0] == 1
+    signature_counts = numpy.zeros((len(features.signatures), token_counts.shape[1]), dtype=token_counts.dtype)
+    numpy.add.at(signature_counts, numpy.frombuffer(features.token_signatures, dtype=numpy.dtype('l'))[rare],
+                 token_counts[rare])
+    counts = numpy.vstack([token_counts, signature_counts, token_counts[rare].sum(axis=0)])
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        result = (counts + alpha) / (tag_counts + vocab_size * alpha).astype(float)
+    result[:, 0] = 0
+    unk_row = len(counts) - 1
+    features.set_rows([vocab_size + i if c else unk_row for i, c in enumerate(signature_counts[:, 0])], unk_row)
+    return result
+
+
+def viterbi(log_trans_prob, log_obser_likeli, seq):
+    """
+    Decode the most probable tag sequence in log space. Each step updates the scores of all the
+    O/B/I states at once.
+
+    :param log_trans_prob: Log transition matrix, from <S>/O/B/I to <S>/O/B/I/<E>
+    :param log_obser_likeli: Log observation matrix
+    :param seq: Token indices of the sentence
+    """
+    l, n = len(seq), len(log_trans_prob)
+    if l == 0:
+        return []
+    trans = log_trans_prob[1:, 1:n]
+    obser = log_obser_likeli[seq, 1:]
+    v = log_trans_prob[0, 1:n] + obser[0]
+    back = numpy.zeros((l, n - 1), dtype='int32')
+    for t in range(1, l):
+        scores = v[:, numpy.newaxis] + trans
+        back[t] = numpy.argmax(scores, axis=0)
+        v = scores[back[t], numpy.arange(n - 1)] + obser[t]
+    result = [numpy.argmax(v + log_trans_prob[1:, n])]
+    for j in range(l - 1, 0, -1):
+        result.append(back[j][result[-1]])
+    result.reverse()
+    return [k + 1 for k in result]
+
+
+def output(fd, pair):
+    for p in pair:
+        fd.write('%s\t%s\n' % (p[0], tag_list[p[1]]))
+    fd.write('\n')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--train', metavar='FILE', help='training data files', default=['data/gene.train.txt'],
+                        type=str, nargs='+')
+    parser.add_argument('--test', metavar='FILE', help='test data file', default='data/HW4-test.txt', type=str)
+    parser.add_argument('--test-rate', metavar='RATE', help='rate of training sentences held out for evaluation',
+                        default=0.0, type=float)
+    parser.add_argument('--seed', metavar='SEED', help='random seed of the held-out split', default=0, type=int)
+    parser.add_argument('--output', metavar='DIR', help='output directory', default='output', type=str)
+    parser.add_argument('--workers', metavar='N', help='count the training data in shards with N worker processes',
+                        default=1, type=int)
+    parser.add_argument('--shard-size', metavar='BYTES', help='size of the training shards (default %d)' %
+                                                              default_shard_size, type=int)
+    parser.add_argument('--shard-cache', metavar='DIR', help='keep the counts of every shard in DIR, so that only '
+                                                             'new or changed shards are counted again', type=str)
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    instrument.start(args)
+    sharded = args.workers > 1 or args.shard_size is not None or args.shard_cache is not None
+    if sharded and args.test_rate > 0.0:
+        parser.error('sharded training (--workers, --shard-size, --shard-cache) needs --test-rate 0')
+
+    with instrument.phase('train'):
+        if sharded:
+            (transition_count, token_counts, tag_count, features), counted, loaded = count_sharded(
+                args.train, args.shard_size or default_shard_size, args.workers, args.shard_cache)
+            instrument.count('shards_counted', counted)
+            instrument.count('shards_loaded', loaded)
+            sys.stderr.write('%d shards: %d counted, %d loaded\n' % (counted + loaded, counted, loaded))
+        else:
+            transition_count, token_counts, tag_count, features = count_tags(
+                split_data(itertools.chain.from_iterable(load_data(path) for path in args.train),
+                           args.test_rate, args.seed))
+    with instrument.phase('matrices'):
+        a = compute_transition_matrix(transition_count)
+        b = compute_observation_matrix(token_counts, tag_count, features)
+        with numpy.errstate(divide='ignore'):
+            log_a, log_b = numpy.log(a), numpy.log(b)
+    decode = instrument.timed(viterbi, 'inference')
+
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+    f2 = open(os.path.join(args.output, 'ans.txt'), 'w')
+    if args.test_rate > 0.0:
+        f1 = open(os.path.join(args.output, 'refer.txt'), 'w')
+        score = IOBScore()
+        for seq in split_data(itertools.chain.from_iterable(load_data(path) for path in args.train),
+                              args.test_rate, args.seed, test=True):
+            output(f1, [(t[0], t[1]) for t in seq])
+            tags = decode(log_a, log_b, features.rows(seq))
+            output(f2, zip([t[0] for t in seq], tags))
+            with instrument.phase('evaluate'):
+                score.add(score_tags([tag_list[t[1]] for t in seq], [tag_list[t] for t in tags]))
+        f1.close()
+        print('Precision: %s Recall: %s F1-measure: %s' % (score.precision(), score.recall(), score.f1()))
+    else:
+        for seq in load_data(args.test, test=True):
+            tags = decode(log_a, log_b, features.rows(seq))
+            output(f2, zip([t[0] for t in seq], tags))
+    f2.close()
+    instrument.finish(args, 'recog')
@@ -1,4 +1,4 @@
 #!/bin/bash
 
-python2 recog.py
+python2 recog.py --test-rate 0.1
 python2 eval.py output/refer.txt output/ans.txt
@@ -0,0 +1,159 @@
+__author__ = 'Jianxiang Fan'
+__email__ = 'jianxiang.fan@colorado.edu'
+
+import argparse
+import itertools
+import json
+import resource
+import subprocess
+import sys
+import time
+
+from seg import Segmenter, WordErrorCounter, base_modes, cached_lexicon, clean_input, gzopen, read_lexicon
+
+timer = getattr(time, 'perf_counter', time.time)
+
+# (name, target file, reference file)
+datasets = [
+    ('train', 'data/hashtags-train.txt', 'data/hashtags-train-reference.txt'),
+    ('test', 'data/hashtags-test-2015.txt', 'data/hashtags-test-refer.txt'),
+    ('dev', 'data/hashtags-dev.txt.gz', None),
+]
+
+
+def percentile(sorted_values, q):
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def peak_rss_kb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def run_config(config):
+    """
+    Build a segmenter for one configuration and segment every dataset with it.
+    Return a list of result dicts, one per dataset.
+
+    :param config: Dict of lexicon, limit, core, cache, base, sw, st, trie and repeat
+    """
+    start = timer()
+    if config['cache']:
+        lex, counts, split_words, short_words = cached_lexicon(config['lexicon'], config['cache'], config['limit'],
+                                                               config['core'], config['st'], config['sw'])
+    else:
+        lex, counts, split_words, short_words = read_lexicon(config['lexicon'], config['limit'],
+                                                             config['st'], config['sw'])
+    segmenter = Segmenter(lex,
+                          split_words=split_words,
+                          short_words=short_words,
+                          core_lexicon=lex[:config['core']],
+                          use_trie=config['trie'],
+                          counts=counts if config['base'] == 'viterbi' else None)
+    build_time = timer() - start
+
+    results = []
+    for name, target, refer in datasets:
+        with gzopen(target, 'r') as f:
+            texts = [clean_input(line) for line in f]
+        latencies = []
+        for i in range(config['repeat']):
+            answers = []
+            for text in texts:
+                start = timer()
+                answers.append(segmenter.match(text, config['base']))
+                latencies.append(timer() - start)
+        latencies.sort()
+        result = dict(config, dataset=name, tags=len(texts), build_sec=build_time,
+                      tags_per_sec=len(latencies) / sum(latencies),
+                      p50_ms=percentile(latencies, 0.5) * 1000, p99_ms=percentile(latencies, 0.99) * 1000,
+                      wer=None, corpus_wer=None)
+        if refer:
+            wers = WordErrorCounter()
+            with gzopen(refer, 'r') as f:
+                for answer, line in zip(answers, f):
+                    wers.add(answer, clean_input(line).split())
+            result['wer'], result['corpus_wer'] = wers.mean_rate(), wers.corpus_rate()
+        # Peak of the process once this dataset is done, including the lexicon and the datasets before it
+        result['peak_rss_kb'] = peak_rss_kb()
+        results.append(result)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compare the results with a baseline run. Return a list of regressions: throughput lower than
+    (1 - tolerance) of the baseline, or a higher WER.
+
+    :param results: Results of this run
+    :param baseline: Results of the baseline run
+    :param tolerance: Allowed relative throughput drop
+    """
+    key = lambda r: (r['dataset'], r['base'], r['sw'], r['st'], r['trie'])
+    base_results = dict((key(r), r) for r in baseline)
+    regressions = []
+    for r in results:
+        b = base_results.get(key(r))
+        if b is None:
+            continue
+        if r['tags_per_sec'] < b['tags_per_sec'] * (1 - tolerance):
+            regressions.append('%s: %.0f tags/sec, baseline %.0f' % (key(r), r['tags_per_sec'], b['tags_per_sec']))
+        if r['wer'] is not None and b['wer'] is not None and r['wer'] > b['wer'] + 1e-9:
+            regressions.append('%s: WER %.4f, baseline %.4f' % (key(r), r['wer'], b['wer']))
+    return regressions
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("--lexicon", help="Lexicon file",
+                           type=str, default="data/bigwordlist.txt.gz", required=False)
+    argparser.add_argument("--limit", help="Limit size of the lexicon",
+                           type=int, default=75000, required=False)
+    argparser.add_argument("--core", help="Limit size of the core lexicon",
+                           type=int, default=2000, required=False)
+    argparser.add_argument("--cache", help="Directory of compiled lexicon files",
+                           type=str, required=False)
+    argparser.add_argument("--modes", help="Comma separated base algorithms to run",
+                           type=str, default=','.join(base_modes), required=False)
+    argparser.add_argument("--repeat", help="Times each dataset is segmented",
+                           type=int, default=5, required=False)
+    argparser.add_argument("--output", help="JSON result file",
+                           type=str, default="bench.json", required=False)
+    argparser.add_argument("--baseline", help="JSON result file of a baseline run to compare with",
+                           type=str, required=False)
+    argparser.add_argument("--tolerance", help="Allowed relative throughput drop from the baseline",
+                           type=float, default=0.2, required=False)
+    argparser.add_argument("--run", help=argparse.SUPPRESS, type=str, required=False)
+    args = argparser.parse_args()
+
+    if args.run:
+        # Run a single configuration in this process, so the peak RSS is its own
+        print(json.dumps(run_config(json.loads(args.run))))
+        sys.exit(0)
+
+    results = []
+    for base, sw, st, trie in itertools.product(args.modes.split(','), [False, True], [False, True],
+                                                [False, True]):
+        if base == 'viterbi' and (sw or st or trie):
+            # Viterbi segmentation always uses the trie and does not repair its result
+            continue
+        config = dict(lexicon=args.lexicon, limit=args.limit, core=args.core, cache=args.cache,
+                      base=base, sw=sw, st=st, trie=trie, repeat=args.repeat)
+        output = subprocess.check_output([sys.executable, sys.argv[0], '--run', json.dumps(config)])
+        for r in json.loads(output.decode('utf-8')):
+            results.append(r)
+            print('%-6s %-10s sw=%-d st=%-d trie=%-d %9.0f tags/sec  p50 %.3fms  p99 %.3fms  build %.2fs  '
+                  'rss %dKB  WER %s' % (r['dataset'], r['base'], r['sw'], r['st'], r['trie'], r['tags_per_sec'],
+                                        r['p50_ms'], r['p99_ms'], r['build_sec'], r['peak_rss_kb'],
+                                        '-' if r['wer'] is None else '%.4f' % r['wer']))
+            sys.stdout.flush()
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print('REGRESSION ' + line)
+        if regressions:
+            sys.exit(1)
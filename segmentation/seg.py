@@ -2,14 +2,260 @@ __author__ = 'Jianxiang Fan'
 __email__ = 'jianxiang.fan@colorado.edu'
 
 import argparse
+import binascii
+import collections
 import gzip
+import hashlib
+import itertools
+import math
+import mmap
+import multiprocessing
+import os
+import struct
+import sys
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common import instrument
 
 # Only use these when working with dev set
 dev_missing_words = ['mentalist', 'espy', 'ipad', 'cuboulder', 'iphone6s', 'teaman']
 
+# Base algorithms of Segmenter.match
+base_modes = ['front', 'back', 'frontback', 'viterbi']
+
+# Compiled lexicon file: magic, sha1 of the source lexicon, limit, core, st, sw, then the offset and
+# length of the words, counts, split tokens and short words sections
+compiled_magic = b'SEGLEX01'
+compiled_header = struct.Struct('<8s20s4q8q')
+
+
+class LexiconTrie:
+    def __init__(self, words, reverse=False):
+        """
+        Build a trie over the words in flat arrays. Nodes are numbered in breadth-first order, node 0
+        being the root, so the children of node n are consecutive: edges first[n] to first[n + 1] - 1
+        lead from n to nodes first[n] + 1 to first[n + 1], and labels holds the character of each edge.
+        The child of n along c is found by labels.find(c, first[n], first[n + 1]) + 1, and word_ids[n]
+        is the index of the word ending at node n, or -1. The trie takes about 9 bytes per node.
+
+        :param words: Words to index, the position of a word in this sequence is its id
+        :param reverse: Index the reversed words, so the trie is walked from the end of a text
+        """
+        self.reverse = reverse
+        ids = {}
+        for i, w in enumerate(words):
+            ids.setdefault(w[::-1] if reverse else w, i)
+        keys = sorted(ids)
+        first, word_ids, labels = array('i'), array('i'), []
+        # The keys of each node are a range of the sorted keys: (start, end, depth) of the nodes in order
+        nodes = collections.deque([(0, len(keys), 0)])
+        next_node = nodes.popleft
+        add_node = nodes.append
+        while nodes:
+            start, end, depth = next_node()
+            first.append(len(labels))
+            # The key ending at this node, if any, sorts first
+            if start < end and len(keys[start]) == depth:
+                word_ids.append(ids[keys[start]])
+                start += 1
+            else:
+                word_ids.append(-1)
+            while start < end:
+                c = keys[start][depth]
+                if keys[end - 1][depth] == c:
+                    # A single child, the case of most nodes
+                    child_end = end
+                else:
+                    child_end = start + 1
+                    while keys[child_end][depth] == c:
+                        child_end += 1
+                labels.append(c)
+                add_node((start, child_end, depth + 1))
+                start = child_end
+        first.append(len(labels))
+        self.first, self.word_ids, self.labels = first, word_ids, ''.join(labels)
+        self.find = instrument.counted(self.labels.find, 'trie_transitions')
+
+    def longest_match(self, text, left, right):
+        """
+        Find the longest word at the start of text[left:right] (or at the end of it for a reversed trie)
+        by a single walk, without slicing the text. Return the end (or start) of the word, or left (or
+        right) if there is none.
+
+        :param text: Text to be searched
+        :param left: Left bound of the search
+        :param right: Right bound of the search
+        """
+        find, first, word_ids = self.find, self.first, self.word_ids
+        node = 0
+        # Iterating over the characters is cheaper than indexing the text at each step
+        if self.reverse:
+            best = i = right
+            for c in reversed(text[left:right]):
+                node = find(c, first[node], first[node + 1]) + 1
+                if not node:
+                    break
+                i -= 1
+                if word_ids[node] >= 0:
+                    best = i
+        else:
+            best = i = left
+            for c in text[left:right]:
+                node = find(c, first[node], first[node + 1]) + 1
+                if not node:
+                    break
+                i += 1
+                if word_ids[node] >= 0:
+                    best = i
+        return best
+
+    def prefixes(self, text, left, right):
+        """
+        Find all the words at the start of text[left:right] by a single walk of a (non reversed) trie.
+        Return a list of (end, word id) pairs, shortest word first.
+
+        :param text: Text to be searched
+        :param left: Left bound of the search
+        :param right: Right bound of the search
+        """
+        find, first, word_ids = self.find, self.first, self.word_ids
+        result = []
+        node = 0
+        i = left
+        while i < right:
+            node = find(text[i], first[node], first[node + 1]) + 1
+            if not node:
+                break
+            i += 1
+            if word_ids[node] >= 0:
+                result.append((i, word_ids[node]))
+        return result
+
+
+class Lattice:
+    def __init__(self, text, prefix_trie):
+        """
+        Enumerate once every lexicon word of the text, by one walk of the prefix trie from each position.
+        The edges are stored in flat arrays: the edges leaving position i are ends[j], word_ids[j] for j in
+        offsets[i]:offsets[i + 1]. A position where no single character word starts also has an edge to the
+        next position with word id -1 (an unknown character), so that every text has a path.
+
+        :param text: Text to be segemented
+        :param prefix_trie: Prefix LexiconTrie of the segmenter
+        """
+        self.text = text
+        self.offsets = array('l', [0])
+        self.ends = array('l')
+        self.word_ids = array('l')
+        l = len(text)
+        for left in range(l):
+            words = prefix_trie.prefixes(text, left, l)
+            if not words or words[0][0] != left + 1:
+                self.ends.append(left + 1)
+                self.word_ids.append(-1)
+            for right, wid in words:
+                self.ends.append(right)
+                self.word_ids.append(wid)
+            self.offsets.append(len(self.ends))
+
+    def edges(self, left):
+        """
+        Return the (end, word id) pairs of the edges leaving a position
+
+        :param left: Position in the text
+        """
+        start, stop = self.offsets[left], self.offsets[left + 1]
+        return list(zip(self.ends[start:stop], self.word_ids[start:stop]))
+
+
+class MatchCache:
+    def __init__(self, max_entries=None, max_bytes=None):
+        """
+        Create a LRU cache of segmentation results keyed by (base, text). Entries are evicted from the
+        least recently used when there are more than max_entries of them, or they take more than
+        max_bytes (as estimated by sys.getsizeof).
+
+        :param max_entries: Max number of entries, unbounded if None
+        :param max_bytes: Max estimated size of the entries, unbounded if None
+        """
+        self.entries = collections.OrderedDict()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries[key] = entry
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, result):
+        if key in self.entries:
+            self.bytes -= self.entries.pop(key)[1]
+        result = tuple(result)
+        size = sys.getsizeof(key[1]) + sys.getsizeof(result) + sum(sys.getsizeof(w) for w in result)
+        self.entries[key] = (result, size)
+        self.bytes += size
+        while self.entries and (self.max_entries is not None and len(self.entries) > self.max_entries or
+                                self.max_bytes is not None and self.bytes > self.max_bytes):
+            self.bytes -= self.entries.popitem(last=False)[1][1]
+            self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'entries': len(self.entries), 'bytes': self.bytes, 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'hit_rate': float(self.hits) / lookups if lookups else 0.0}
+
+    def save(self, filename, signature):
+        """
+        Write the entries from the least to the most recently used, one "base<TAB>text<TAB>words" line
+        each, after a first line holding the signature of the segmenter configuration. Entries which
+        can not be written this way (text with tabs, words with spaces) are skipped.
+
+        :param filename: Cache file
+        :param signature: Signature of the segmenter configuration
+        """
+        lines = [signature]
+        for (base, text), (result, _) in self.entries.items():
+            if '\t' not in text and '\n' not in text and not any(' ' in w or '\n' in w for w in result):
+                lines.append('%s\t%s\t%s' % (base, text, ' '.join(result)))
+        with open(filename, 'wb') as f:
+            f.write(encode_lines(lines))
+
+    def load(self, filename, signature):
+        """
+        Warm the cache from a file written by save. The file is ignored if it does not exist or its
+        signature differs. Return the number of entries loaded.
+
+        :param filename: Cache file
+        :param signature: Signature of the segmenter configuration
+        """
+        if not os.path.exists(filename):
+            return 0
+        with open(filename, 'rb') as f:
+            lines = decode_lines(f.read())
+        if not lines or lines[0] != signature:
+            return 0
+        for line in lines[1:]:
+            base, text, words = line.split('\t')
+            # A blank line has no words, which split would read back as ['']
+            self.put((base, text), words.split(' ') if words else [])
+        return len(lines) - 1
+
 
 class Segmenter:
-    def __init__(self, lexicon, core_lexicon=None, split_words=None, extra_words=None, short_words=None):
+    def __init__(self, lexicon, core_lexicon=None, split_words=None, extra_words=None, short_words=None,
+                 use_trie=False, counts=None, bigrams=None, cache=None):
         """
         Create segmenter using certain lexicon
 
@@ -17,19 +263,91 @@ class Segmenter:
         :param split_words: The dict to split words
         :param extra_words: Extra words should be added into lexicon
         :param short_words: Common short words list
+        :param use_trie: Look up words by walking prefix/suffix tries instead of probing the lexicon set,
+            which is slower for hashtags but faster for long texts with few lexicon words
+        :param counts: Word counts in the same order as lexicon, required by viterbi segmentation
+        :param bigrams: Dict of (word, word) pair counts, used by viterbi segmentation if given
+        :param cache: MatchCache of the results of match
         """
-        self.lexicon = set(lexicon) | set(extra_words or [])
-        self.word_max_len = max(len(w) for w in self.lexicon)
         self.split_words = split_words
         self.short_words = short_words
-        self.core_lexicon = core_lexicon or lexicon
+        # A set, since front_back_max_match probes it at every step
+        self.core_lexicon = frozenset(core_lexicon or lexicon)
+        self.cache = cache
+
+        # Word ids are positions in self.words, the lexicon order followed by the extra words
+        self.words = []
+        word_ids = {}
+        for w in list(lexicon) + list(extra_words or []):
+            if w not in word_ids:
+                word_ids[w] = len(self.words)
+                self.words.append(w)
+        self.word_max_len = max(len(w) for w in self.words)
+        if use_trie or counts is not None:
+            # The tries find every word, so the lexicon set is not kept
+            self.lexicon = None
+            self.prefix_trie = LexiconTrie(self.words)
+            self.suffix_trie = LexiconTrie(self.words, reverse=True)
+        else:
+            self.lexicon = instrument.counting(set(self.words), 'lexicon_probes')
+            self.prefix_trie = self.suffix_trie = None
+
+        self.log_probs = None
+        self.unknown_log_prob = None
+        self.bigram_log_probs = None
+        if counts is not None:
+            self.compute_log_probs(lexicon, counts, word_ids, bigrams)
+
+    def compute_log_probs(self, lexicon, counts, word_ids, bigrams=None):
+        """
+        Precompute the unigram log probability of every word id. Extra words without counts get the
+        smallest count in the lexicon. An unknown character costs as much as a word seen once.
+        If bigrams are given, also compute log P(w2 | w1) for every known pair of word ids.
+
+        :param lexicon: The lexicon used to segement
+        :param counts: Word counts in the same order as lexicon
+        :param word_ids: Dict from words to their ids
+        :param bigrams: Dict of (word, word) pair counts
+        """
+        word_counts = [0] * len(self.words)
+        for w, c in zip(lexicon, counts):
+            word_counts[word_ids[w]] += c
+        floor = min(counts)
+        word_counts = [c or floor for c in word_counts]
+        total = float(sum(word_counts))
+        self.log_probs = array('d', [math.log(c / total) for c in word_counts])
+        self.unknown_log_prob = -math.log(total)
+        if bigrams:
+            self.bigram_log_probs = {}
+            for (w1, w2), c in bigrams.items():
+                if w1 in word_ids and w2 in word_ids:
+                    i, j = word_ids[w1], word_ids[w2]
+                    self.bigram_log_probs[i, j] = min(math.log(float(c) / word_counts[i]), 0.0)
 
     def match(self, text, base=None):
+        """
+        Segment the text as segment does, looking the result up in the cache first if there is one
+
+        :param text: Text to be segemented
+        """
+        if self.cache is None:
+            return self.segment(text, base)
+        key = (base or "front", text)
+        result = self.cache.get(key)
+        if result is None:
+            result = self.segment(text, base)
+            self.cache.put(key, result)
+        return list(result)
+
+    def segment(self, text, base=None):
         """
         Segment the text by MaxMatch use base algorithm and then split words
 
         :param text: Text to be segemented
         """
+        if base == "viterbi":
+            # Viterbi segmentation picks the most probable words itself, no need to repair the result
+            return self.viterbi_match(text)
         if base == "back":
             match_func = self.back_max_match
         elif base == "frontback":
@@ -64,6 +382,143 @@ class Segmenter:
                     i += 1
         return result
 
+    def viterbi_match(self, text):
+        """
+        Segment the text into the most probable word sequence by dynamic programming over the word
+        log probabilities. The words starting at each position are enumerated by one walk of the
+        prefix trie. Characters not covered by any word are left as single character tokens.
+
+        :param text: Text to be segemented
+        """
+        if self.log_probs is None:
+            raise ValueError('viterbi segmentation needs a segmenter built with word counts')
+        if self.bigram_log_probs:
+            return self.bigram_viterbi_match(text)
+        l = len(text)
+        log_probs, unknown_log_prob = self.log_probs, self.unknown_log_prob
+        score = [0.0] + [float('-inf')] * l
+        back = [0] * (l + 1)
+        for left in range(l):
+            s = score[left]
+            if s + unknown_log_prob > score[left + 1]:
+                score[left + 1] = s + unknown_log_prob
+                back[left + 1] = left
+            for right, wid in self.prefix_trie.prefixes(text, left, l):
+                if s + log_probs[wid] > score[right]:
+                    score[right] = s + log_probs[wid]
+                    back[right] = left
+        result = []
+        right = l
+        while right > 0:
+            left = back[right]
+            result.append(text[left:right])
+            right = left
+        return result[::-1]
+
+    def bigram_viterbi_match(self, text):
+        """
+        Viterbi segmentation with a bigram model. The state at each position is the id of the last
+        word (-1 for the start and unknown characters), unseen pairs back off to the unigram model.
+
+        :param text: Text to be segemented
+        """
+        l = len(text)
+        log_probs, bigram_log_probs = self.log_probs, self.bigram_log_probs
+        backoff_log_prob = math.log(0.4)
+        states = [{} for i in range(l + 1)]
+        states[0][-1] = (0.0, 0, -1)
+        for left in range(l):
+            candidates = [(left + 1, -1)] + self.prefix_trie.prefixes(text, left, l)
+            for prev, (s, _, _) in states[left].items():
+                for right, wid in candidates:
+                    if wid < 0:
+                        p = s + self.unknown_log_prob
+                    elif (prev, wid) in bigram_log_probs:
+                        p = s + bigram_log_probs[prev, wid]
+                    else:
+                        p = s + backoff_log_prob + log_probs[wid]
+                    state = states[right].get(wid)
+                    if state is None or p > state[0]:
+                        states[right][wid] = (p, left, prev)
+        result = []
+        right = l
+        wid = max(states[l], key=lambda k: states[l][k][0]) if l else -1
+        while right > 0:
+            _, left, prev = states[right][wid]
+            result.append(text[left:right])
+            right, wid = left, prev
+        return result[::-1]
+
+    def lattice(self, text):
+        """
+        Return the Lattice of the lexicon words of the text
+
+        :param text: Text to be segemented
+        """
+        return Lattice(text, self.prefix_trie)
+
+    def k_best(self, text, k):
+        """
+        Return the k most probable segmentations of the text as (log probability, words) pairs, best
+        first. The words are enumerated once in a lattice, and each position keeps the k best paths ending
+        there (score, start and id of the last word, rank of the path it extends). The first segmentation
+        is the one of viterbi_match with unigram counts. If bigrams are given, the k segmentations are then
+        rescored and reordered by the bigram model.
+
+        :param text: Text to be segemented
+        :param k: Number of segmentations
+        """
+        if self.log_probs is None:
+            raise ValueError('viterbi segmentation needs a segmenter built with word counts')
+        l = len(text)
+        lattice = self.lattice(text)
+        log_probs, unknown_log_prob = self.log_probs, self.unknown_log_prob
+        paths = [[] for i in range(l + 1)]
+        paths[0] = [(0.0, 0, -1, 0)]
+        for left in range(l):
+            if len(paths[left]) > k:
+                # Sorting is stable, so ties keep the first path found, as viterbi_match does
+                paths[left] = sorted(paths[left], key=lambda p: p[0], reverse=True)[:k]
+            edges = lattice.edges(left)
+            for rank, (s, _, _, _) in enumerate(paths[left]):
+                for right, wid in edges:
+                    paths[right].append((s + (unknown_log_prob if wid < 0 else log_probs[wid]), left, wid, rank))
+        ends = sorted(paths[l], key=lambda p: p[0], reverse=True)[:k] if l else [(0.0, 0, -1, 0)]
+        result = []
+        for s, left, wid, rank in ends:
+            words, wids = [], []
+            right = l
+            while right > 0:
+                words.append(text[left:right])
+                wids.append(wid)
+                right = left
+                _, left, wid, rank = paths[right][rank]
+            if self.bigram_log_probs:
+                s = self.bigram_log_prob(wids[::-1])
+            result.append((s, words[::-1]))
+        if self.bigram_log_probs:
+            result.sort(key=lambda r: r[0], reverse=True)
+        return result
+
+    def bigram_log_prob(self, wids):
+        """
+        Return the log probability of a segmentation with the bigram model of bigram_viterbi_match
+
+        :param wids: Word ids of the segmentation, -1 for unknown characters
+        """
+        backoff_log_prob = math.log(0.4)
+        result = 0.0
+        prev = -1
+        for wid in wids:
+            if wid < 0:
+                result += self.unknown_log_prob
+            elif (prev, wid) in self.bigram_log_probs:
+                result += self.bigram_log_probs[prev, wid]
+            else:
+                result += backoff_log_prob + self.log_probs[wid]
+            prev = wid
+        return result
+
     def front_back_max_match(self, text):
         """
         Segment the text by MaxMatch algorithm simultaneously from the front and back
@@ -78,21 +533,9 @@ class Segmenter:
             if text[fl:br] in self.core_lexicon:
                 front_result.append(text[fl:br])
                 break
-            fr = min(fl + self.word_max_len, br if back_stop else l)
-            bl = max(br - self.word_max_len, fl if front_stop else 0)
-            front_word, back_word = '', ''
-            while not front_stop and fr > fl:
-                if text[fl:fr] in self.lexicon:
-                    front_word = text[fl:fr]
-                    break
-                else:
-                    fr -= 1
-            while not back_stop and br > bl:
-                if text[bl:br] in self.lexicon:
-                    back_word = text[bl:br]
-                    break
-                else:
-                    bl += 1
+            fr = fl if front_stop else self.find_front_word(text, fl, br if back_stop else l)
+            bl = br if back_stop else self.find_back_word(text, fl if front_stop else 0, br)
+            front_word, back_word = text[fl:fr], text[bl:br]
             if front_word and back_word and fr <= bl:
                 front_result.append(front_word)
                 back_result.append(back_word)
@@ -125,17 +568,12 @@ class Segmenter:
         l = len(text)
         right = l
         while right > 0:
-            left = max(right - self.word_max_len, 0)
-            while right > left:
-                if text[left:right] in self.lexicon:
-                    result.append(text[left:right])
-                    break
-                else:
-                    left += 1
+            left = self.find_back_word(text, 0, right)
             if right == left:
                 result.append(text[right - 1])
                 right -= 1
             else:
+                result.append(text[left:right])
                 right = left
         return result[::-1]
 
@@ -149,47 +587,135 @@ class Segmenter:
         l = len(text)
         left = 0
         while left < l:
-            right = min(left + self.word_max_len, l)
-            while right > left:
-                if text[left:right] in self.lexicon:
-                    result.append(text[left:right])
-                    break
-                else:
-                    right -= 1
+            right = self.find_front_word(text, left, l)
             if right == left:
                 result.append(text[left])
                 left += 1
             else:
+                result.append(text[left:right])
                 left = right
         return result
 
+    def find_front_word(self, text, left, right):
+        """
+        Find the longest lexicon word starting at left and ending no later than right, return its end
+        index, or left if there is no such word
+
+        :param text: Text to be searched
+        :param left: Start of the word
+        :param right: Right bound of the word
+        """
+        if self.prefix_trie:
+            return self.prefix_trie.longest_match(text, left, right)
+        end = min(left + self.word_max_len, right)
+        while end > left:
+            if text[left:end] in self.lexicon:
+                return end
+            end -= 1
+        return left
+
+    def find_back_word(self, text, left, right):
+        """
+        Find the longest lexicon word ending at right and starting no earlier than left, return its
+        start index, or right if there is no such word
+
+        :param text: Text to be searched
+        :param left: Left bound of the word
+        :param right: End of the word
+        """
+        if self.suffix_trie:
+            return self.suffix_trie.longest_match(text, left, right)
+        start = max(right - self.word_max_len, left)
+        while start < right:
+            if text[start:right] in self.lexicon:
+                return start
+            start += 1
+        return right
+
 
-def min_edit_dist(target, source):
+def min_edit_dist(target, source, max_dist=None):
     """
     Computes the min edit distance from target to source. Figure 3.25 in the book. Assume that
     insertions, deletions and (actual) substitutions all cost 1 for this HW. Note the indexes are a
     little different from the text. There we are assuming the source and target indexing starts a 1.
-    Here we are using 0-based indexing.
+    Here we are using 0-based indexing. Only the previous row of the distance table is kept.
+
+    If max_dist is given, only the band of cells within max_dist of the diagonal is computed, and
+    max_dist + 1 is returned as soon as the distance is known to exceed max_dist.
 
     :param target: Target words sequence
     :param source: Source words sequence
+    :param max_dist: Max distance of interest
     """
-    insert_cost = lambda s: 1
-    delete_cost = lambda s: 1
-    subst_cost = lambda s, t: 0 if s == t else 1
     n, m = len(target), len(source)
+    if max_dist is None:
+        prev = list(range(m + 1))
+        for i, t in enumerate(target, 1):
+            cur = [i]
+            left = i
+            for j, s in enumerate(source):
+                d = prev[j] + (s != t)
+                if prev[j + 1] < d:
+                    d = prev[j + 1] + 1
+                if left < d:
+                    d = left + 1
+                cur.append(d)
+                left = d
+            prev = cur
+        return prev[m]
 
-    distance = [[0 for i in range(m + 1)] for j in range(n + 1)]
+    over = max_dist + 1
+    if abs(n - m) > max_dist:
+        return over
+    prev = [j if j <= max_dist else over for j in range(m + 1)]
     for i in range(1, n + 1):
-        distance[i][0] = distance[i - 1][0] + insert_cost(target[i - 1])
-    for j in range(1, m + 1):
-        distance[0][j] = distance[0][j - 1] + delete_cost(source[j - 1])
+        t = target[i - 1]
+        lo, hi = max(1, i - max_dist), min(m, i + max_dist)
+        cur = [over] * (m + 1)
+        if i <= max_dist:
+            cur[0] = i
+        for j in range(lo, hi + 1):
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (source[j - 1] != t), over)
+        if min(cur[lo - 1:hi + 1]) > max_dist:
+            return over
+        prev = cur
+    return prev[m]
+
+
+def batch_min_edit_dist(pairs):
+    """
+    Compute the min edit distances of many (target, source) pairs at once. With NumPy, words are
+    mapped to integer ids and each row of the distance tables of all the pairs is computed together.
+
+    :param pairs: List of (target words sequence, source words sequence) pairs
+    """
+    if numpy is None or not pairs:
+        return [min_edit_dist(t, s) for t, s in pairs]
+    ids = {}
+    b = len(pairs)
+    target_lens = numpy.array([len(t) for t, s in pairs])
+    source_lens = numpy.array([len(s) for t, s in pairs])
+    n, m = target_lens.max(), source_lens.max()
+    # Padding ids differ between target and source, so padding never matches
+    targets = numpy.full((b, n), -1, dtype=int)
+    sources = numpy.full((b, m), -2, dtype=int)
+    for k, (t, s) in enumerate(pairs):
+        targets[k, :len(t)] = [ids.setdefault(w, len(ids)) for w in t]
+        sources[k, :len(s)] = [ids.setdefault(w, len(ids)) for w in s]
+
+    result = source_lens.copy()
+    rows = numpy.arange(b)
+    prev = numpy.tile(numpy.arange(m + 1), (b, 1))
     for i in range(1, n + 1):
+        best = numpy.minimum(prev[:, 1:] + 1, prev[:, :-1] + (sources != targets[:, i - 1:i]))
+        cur = numpy.empty_like(prev)
+        cur[:, 0] = i
         for j in range(1, m + 1):
-            distance[i][j] = min(distance[i - 1][j] + insert_cost(target[i - 1]),
-                                 distance[i][j - 1] + insert_cost(source[j - 1]),
-                                 distance[i - 1][j - 1] + subst_cost(source[j - 1], target[i - 1]))
-    return distance[n][m]
+            cur[:, j] = numpy.minimum(best[:, j - 1], cur[:, j - 1] + 1)
+        done = target_lens == i
+        result[done] = cur[rows[done], source_lens[done]]
+        prev = cur
+    return result.tolist()
 
 
 def word_error_rate(target, source):
@@ -205,6 +731,45 @@ def word_error_rate(target, source):
     return float(min_edit_dist(target, source)) / len(source)
 
 
+class WordErrorCounter:
+    def __init__(self, batch_size=1000):
+        """
+        Accumulate the WER of (target, source) pairs. Pairs are scored in batches by
+        batch_min_edit_dist.
+
+        :param batch_size: Number of pairs scored at a time
+        """
+        self.batch_size = batch_size
+        self.pending = []
+        self.count = 0
+        self.rate_sum = 0.0
+        self.edits = 0
+        self.source_words = 0
+
+    def add(self, target, source):
+        self.pending.append((target, source))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        for (t, s), d in zip(self.pending, batch_min_edit_dist(self.pending)):
+            self.rate_sum += float(d) / len(s)
+            self.edits += d
+            self.source_words += len(s)
+            self.count += 1
+        self.pending = []
+
+    def mean_rate(self):
+        """Mean of the WER of each pair, 0 without pairs"""
+        self.flush()
+        return self.rate_sum / self.count if self.count else 0.0
+
+    def corpus_rate(self):
+        """Total edits over total source words, 0 without source words"""
+        self.flush()
+        return float(self.edits) / self.source_words if self.source_words else 0.0
+
+
 def gzopen(filename, mode):
     """
     Open a gzip-compressed file or a plain text file.
@@ -213,11 +778,71 @@ def gzopen(filename, mode):
     :param mode
     """
     if filename.endswith('gz'):
-        return gzip.open(filename, mode)
+        # Python 3 gzip files are binary by default, write text like a plain file does
+        return gzip.open(filename, mode + 't' if 'w' in mode and str is not bytes else mode)
     else:
         return open(filename, mode)
 
 
+# The segmenter of the worker pool, set before the pool is forked so workers share it copy-on-write
+worker_segmenter = None
+
+
+def segment_chunk(task):
+    base, texts = task
+    return [worker_segmenter.segment(text, base) for text in texts]
+
+
+def segment_lines(segmenter, lines, base=None, workers=1, chunk_size=1000):
+    """
+    Segment the lines and yield the results in input order. With more than one worker, chunks of lines
+    are segmented by a pool of forked processes sharing the segmenter. At most 2 * workers chunks are
+    in flight, so the lines are streamed rather than read at once. The cache of the segmenter is only
+    used by this process, workers are sent the texts missing from it.
+
+    :param segmenter: The segmenter
+    :param lines: Iterable of raw input lines
+    :param base: Base algorithm of Segmenter.match
+    :param workers: Number of worker processes
+    :param chunk_size: Number of lines sent to a worker at a time
+    """
+    if workers <= 1:
+        match = instrument.timed(segmenter.match, 'segment')
+        for line in lines:
+            yield match(clean_input(line), base)
+        return
+    global worker_segmenter
+    worker_segmenter = segmenter
+    context = multiprocessing.get_context('fork') if hasattr(multiprocessing, 'get_context') else multiprocessing
+    pool = context.Pool(workers)
+    try:
+        cache = segmenter.cache
+        key_base = base or "front"
+        lines = iter(lines)
+        pending = collections.deque()
+        while True:
+            texts = [clean_input(line) for line in itertools.islice(lines, chunk_size)]
+            if texts:
+                results = [cache.get((key_base, text)) for text in texts] if cache else [None] * len(texts)
+                misses = [text for text, result in zip(texts, results) if result is None]
+                pending.append((texts, results, pool.apply_async(segment_chunk, ((base, misses),))))
+            if not pending:
+                break
+            if len(pending) >= 2 * workers or not texts:
+                texts, results, computed = pending.popleft()
+                computed = iter(computed.get())
+                for text, result in zip(texts, results):
+                    if result is None:
+                        result = next(computed)
+                        if cache:
+                            cache.put((key_base, text), result)
+                    yield list(result)
+    finally:
+        pool.terminate()
+        pool.join()
+        worker_segmenter = None
+
+
 def get_split_tokens(lexicon, refer_words, low_limit):
     """
     Split some strange combine tokens into common words, return split result dict
@@ -240,6 +865,134 @@ def get_common_short_words(lexicon, word_length, bound, extra=None):
     return [w for w in lexicon[:bound] if 1 < len(w) <= word_length] + (extra or ['a', 'i', 'u'])
 
 
+def clean_input(s):
+    return s.decode(encoding='utf-8').strip(' \t\n\r#').lower() \
+        if type(s) is not str else s.strip(' \t\n\r#').lower()
+
+
+def read_lexicon(filename, limit, st=False, sw=False):
+    """
+    Read the lexicon file and build the tables used by the segmenter.
+    Return (words, counts, split tokens, short words), counts is None if the file has no count column.
+
+    :param filename: Lexicon file, one word per line optionally followed by a tab and its count
+    :param limit: Limit size of the lexicon
+    :param st: Build the split tokens dict
+    :param sw: Build the common short words list
+    """
+    with gzopen(filename, 'r') as f:
+        rows = [clean_input(line).split('\t') for line in itertools.islice(f, limit)]
+    lex = [r[0] for r in rows]
+    counts = [int(r[1]) for r in rows] if all(len(r) > 1 for r in rows) else None
+    return (lex, counts,
+            get_split_tokens(lex, lex[:50], 20000) if st else None,
+            get_common_short_words(lex, 2, 200) if sw else None)
+
+
+def file_digest(filename):
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.digest()
+
+
+def encode_lines(lines):
+    return '\n'.join(lines).encode('utf-8') if str is not bytes else '\n'.join(lines)
+
+
+def decode_lines(data):
+    return (data.decode('utf-8') if str is not bytes else data).split('\n') if data else []
+
+
+def compile_lexicon(filename, output, limit, core, st=False, sw=False):
+    """
+    Read the lexicon and write its tables to a compiled binary file, which can be memory-mapped by
+    load_compiled_lexicon. The file records the sha1 of the source lexicon and the parameters.
+    Return the tables as read_lexicon does.
+
+    :param filename: Lexicon file
+    :param output: Compiled lexicon file
+    :param limit: Limit size of the lexicon
+    :param core: Limit size of the core lexicon
+    :param st: Build the split tokens dict
+    :param sw: Build the common short words list
+    """
+    tables = read_lexicon(filename, limit, st, sw)
+    lex, counts, split_words, short_words = tables
+    sections = [encode_lines(lex),
+                struct.pack('<%dq' % len(counts), *counts) if counts else b'',
+                encode_lines('%s\t%s' % (k, ' '.join(v)) for k, v in sorted((split_words or {}).items())),
+                encode_lines(short_words or [])]
+    layout = []
+    offset = compiled_header.size
+    for data in sections:
+        layout += [offset, len(data)]
+        offset += len(data)
+    # A temp file per process, so that processes compiling the same lexicon at once never share one
+    tmp = '%s.%d.tmp' % (output, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(compiled_header.pack(compiled_magic, file_digest(filename), limit, core, int(st), int(sw),
+                                     *layout))
+        for data in sections:
+            f.write(data)
+    os.rename(tmp, output)
+    return tables
+
+
+def load_compiled_lexicon(filename, compiled, limit, core, st=False, sw=False):
+    """
+    Load the tables from a compiled lexicon file by memory-mapping it.
+    Return None if the file does not exist, or was compiled from another version of the lexicon or
+    with other parameters.
+
+    :param filename: Lexicon file the compiled file should be built from
+    :param compiled: Compiled lexicon file
+    :param limit: Limit size of the lexicon
+    :param core: Limit size of the core lexicon
+    :param st: Whether the split tokens dict is needed
+    :param sw: Whether the common short words list is needed
+    """
+    if not os.path.exists(compiled):
+        return None
+    with open(compiled, 'rb') as f:
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if len(m) < compiled_header.size:
+            return None
+        header = compiled_header.unpack_from(m, 0)
+        if header[:6] != (compiled_magic, file_digest(filename), limit, core, int(st), int(sw)):
+            return None
+        sections = [m[header[i]:header[i] + header[i + 1]] for i in range(6, 14, 2)]
+    finally:
+        m.close()
+    lex = decode_lines(sections[0])
+    counts = list(struct.unpack('<%dq' % (len(sections[1]) // 8), sections[1])) if sections[1] else None
+    split_words = dict((k, v.split(' ')) for k, v in (l.split('\t') for l in decode_lines(sections[2])))
+    return lex, counts, split_words if st else None, decode_lines(sections[3]) if sw else None
+
+
+def cached_lexicon(filename, cache_dir, limit, core, st=False, sw=False):
+    """
+    Return the lexicon tables as read_lexicon does, from the compiled file for these parameters in
+    cache_dir. The file is (re)compiled if it is missing or the source lexicon has changed.
+
+    :param filename: Lexicon file
+    :param cache_dir: Directory of the compiled lexicon files
+    :param limit: Limit size of the lexicon
+    :param core: Limit size of the core lexicon
+    :param st: Build the split tokens dict
+    :param sw: Build the common short words list
+    """
+    compiled = os.path.join(cache_dir, '%s-%d-%d-%d-%d.lex' % (os.path.basename(filename), limit, core, st, sw))
+    tables = load_compiled_lexicon(filename, compiled, limit, core, st, sw)
+    if tables is None:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        tables = compile_lexicon(filename, compiled, limit, core, st, sw)
+    return tables
+
+
 if __name__ == '__main__':
     argparser = argparse.ArgumentParser()
     argparser.add_argument("--target", help="Target file to segment",
@@ -259,29 +1012,94 @@ if __name__ == '__main__':
     argparser.add_argument("--sw", help="Short word check", action='store_true')
     argparser.add_argument("--st", help="Split combine tokens", action='store_true')
     argparser.add_argument("--dev", help="Dev mode, add extra words", action='store_true')
+    argparser.add_argument("--trie", help="Use trie lexicon index, faster than the lexicon set only on long texts "
+                                          "with few lexicon words", action='store_true')
+    argparser.add_argument("--vt", help="Use viterbi segmentation with word counts", action='store_true')
+    argparser.add_argument("--bigrams", help="Bigram counts file for viterbi segmentation",
+                           type=str, required=False)
+    argparser.add_argument("--nbest", help="With --vt, write the NBEST most probable segmentations of each line, "
+                                           "separated by tabs (in a single process)",
+                           type=int, required=False)
+    argparser.add_argument("--cache", help="Directory of compiled lexicon files",
+                           type=str, required=False)
+    argparser.add_argument("--workers", help="Number of worker processes",
+                           type=int, default=1, required=False)
+    argparser.add_argument("--memo", help="Cache up to MEMO segmentation results",
+                           type=int, required=False)
+    argparser.add_argument("--memo-bytes", help="Cache segmentation results up to MEMO_BYTES bytes",
+                           type=int, required=False)
+    argparser.add_argument("--memo-file", help="File to warm the segmentation cache from and save it to",
+                           type=str, required=False)
+    argparser.add_argument("--corpus-wer", help="Also print total edits over total reference words",
+                           action='store_true')
+    instrument.add_arguments(argparser)
     args = argparser.parse_args()
+    if args.nbest and not args.vt:
+        argparser.error('--nbest needs --vt')
+    instrument.start(args)
 
-    clean_input = lambda s: s.decode(encoding='utf-8').strip(' \t\n\r#').lower() \
-        if type(s) is not str else s.strip(' \t\n\r#').lower()
+    with instrument.phase('lexicon_load'):
+        if args.cache:
+            lex, counts, split_words, short_words = cached_lexicon(args.lexicon, args.cache, args.limit, args.core,
+                                                                   args.st, args.sw)
+        else:
+            lex, counts, split_words, short_words = read_lexicon(args.lexicon, args.limit, args.st, args.sw)
+    if args.vt and counts is None:
+        argparser.error('--vt needs a lexicon with counts')
 
-    with gzopen(args.lexicon, 'r') as f1, gzopen(args.target, 'r') as f2, open(args.output, 'w') as f3:
-        lex = [clean_input(line).split('\t')[0] for line in f1][:args.limit]
-        segmenter = Segmenter(lex,
-                              split_words=get_split_tokens(lex, lex[:50], 20000) if args.st else None,
-                              extra_words=dev_missing_words if args.dev else None,
-                              short_words=get_common_short_words(lex, 2, 200) if args.sw else None,
-                              core_lexicon=lex[:args.core])
+    with gzopen(args.target, 'r') as f2, gzopen(args.output, 'w') as f3:
+        bigram_counts = None
+        if args.vt and args.bigrams:
+            with gzopen(args.bigrams, 'r') as f5:
+                bigram_counts = dict((tuple(p[0].split()), int(p[1])) for p in
+                                     (clean_input(line).split('\t') for line in f5))
+        memo = None
+        if args.memo or args.memo_bytes or args.memo_file:
+            memo = MatchCache(args.memo, args.memo_bytes)
+            memo_signature = ' '.join(str(x) for x in (
+                os.path.basename(args.lexicon), binascii.hexlify(file_digest(args.lexicon)).decode('ascii'), args.limit,
+                args.core, args.st, args.sw, args.dev, args.bigrams,
+                binascii.hexlify(file_digest(args.bigrams)).decode('ascii') if args.bigrams else None))
+            if args.memo_file:
+                memo.load(args.memo_file, memo_signature)
+        with instrument.phase('build'):
+            segmenter = Segmenter(lex,
+                                  split_words=split_words,
+                                  extra_words=dev_missing_words if args.dev else None,
+                                  short_words=short_words,
+                                  core_lexicon=lex[:args.core],
+                                  use_trie=args.trie,
+                                  counts=counts if args.vt else None,
+                                  bigrams=bigram_counts,
+                                  cache=memo)
 
-        base_match = "frontback" if args.fb else "back" if args.bk else "front"
-        seg_answers = (segmenter.match(clean_input(line), base_match) for line in f2)
+        base_match = "viterbi" if args.vt else "frontback" if args.fb else "back" if args.bk else "front"
+        if args.nbest:
+            k_best = instrument.timed(segmenter.k_best, 'segment')
+            seg_answers = ([words for _, words in k_best(clean_input(line), args.nbest)] for line in f2)
+        else:
+            seg_answers = ([p] for p in segment_lines(segmenter, f2, base_match, args.workers))
         f4 = gzopen(args.refer, 'r') if args.refer else None
         ref_answers = (clean_input(line).split() for line in f4) if f4 else None
-        wers = []
-        for p in seg_answers:
+        wers = WordErrorCounter()
+        add_wer = instrument.timed(wers.add, 'evaluate')
+        for ps in seg_answers:
             if ref_answers:
-                wers.append(word_error_rate(p, next(ref_answers)))
-            f3.write(' '.join(p) + '\n')
+                add_wer(ps[0], next(ref_answers))
+            f3.write('\t'.join(' '.join(p) for p in ps) + '\n')
         if f4:
             f4.close()
-        if wers:
-            print(sum(wers) / len(wers))
+        if memo:
+            if args.memo_file:
+                memo.save(args.memo_file, memo_signature)
+            sys.stderr.write('cache: %s\n' % ', '.join('%s=%s' % kv for kv in sorted(memo.stats().items())))
+        if ref_answers:
+            # The counter flushes its last batch of distances here
+            with instrument.phase('evaluate', calls=0):
+                mean_rate = wers.mean_rate()
+            # As before, nothing is printed without lines to score
+            if wers.count:
+                print(mean_rate)
+                if args.corpus_wer:
+                    print(wers.corpus_rate())
+    instrument.finish(args, 'seg')
@@ -0,0 +1,38 @@
+__author__ = 'Jianxiang Fan'
+__email__ = 'jianxiang.fan@colorado.edu'
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from seg import MatchCache
+
+
+class MatchCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'memo.txt')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_save_load(self):
+        cache = MatchCache()
+        cache.put(('front', ''), [])
+        cache.put(('front', 'newyork'), ['new', 'york'])
+        cache.save(self.filename, 'sig')
+        loaded = MatchCache()
+        self.assertEqual(loaded.load(self.filename, 'sig'), 2)
+        self.assertEqual(loaded.get(('front', '')), ())
+        self.assertEqual(loaded.get(('front', 'newyork')), ('new', 'york'))
+
+    def test_signature_mismatch(self):
+        cache = MatchCache()
+        cache.put(('front', 'newyork'), ['new', 'york'])
+        cache.save(self.filename, 'sig')
+        self.assertEqual(MatchCache().load(self.filename, 'other'), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
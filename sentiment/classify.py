@@ -1,85 +1,35 @@
 __author__ = 'Jianxiang Fan'
 __email__ = 'jianxiang.fan@colorado.edu'
 
-import math
-import string
+import itertools
+import os
+import sys
 import argparse
 import random
 
+import numpy
 
-def base_filter():
-    return string.punctuation + '\t\n\r'
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common.dataset import chunks, fold_of, read_records, reservoir_sample, split_records
+from common import instrument
+from common.naive_bayes import NaiveBayes
+from common.sweep import NaiveBayesSweep, count_matrix, parse_values, sweep_tokenizer
 
 
-def text_to_sequence(text, filters=base_filter(), split=" "):
-    text = text.lower().translate(string.maketrans(filters, split * len(filters)))
-    seq = text.split(split)
-    return [_f for _f in seq if _f]
+def read_dataset(pos_path, neg_path):
+    return itertools.chain(read_records(pos_path, label=1), read_records(neg_path, label=0))
 
 
-def load_dataset(path, label=None, k=0):
-    d = []
-    with open(path) as f:
-        for line in f:
-            p = line.split('\t')
-            d.append((p[0], p[1], label))
-    if k != 0:
-        random.shuffle(d)
-        dev_size = len(d) / k
-        for i in range(k):
-            yield d[:i * dev_size] + d[(i + 1) * dev_size:], d[i * dev_size:(i + 1) * dev_size]
-    else:
-        yield d
-
-
-class Classifier(object):
-    def __init__(self):
-        self.doc_counts = {}
-        self.word_counts = {}
-        self.pos_counts = {}
-        self.neg_counts = {}
-        self.prior = {}
-        self.pos_likelihood = {}
-        self.neg_likelihood = {}
-        self.effective_words = None
-
-    def clear(self):
-        self.doc_counts.clear()
-        self.word_counts.clear()
-        self.pos_counts.clear()
-        self.neg_counts.clear()
-
-    def fit_on_texts(self, data):
-        for tid, text, label in data:
-            self.doc_counts[label] = self.doc_counts.get(label, 0) + 1
-            for w in text_to_sequence(text):
-                self.word_counts[w] = self.word_counts.get(w, 0) + 1
-                if label == 1:
-                    self.pos_counts[w] = self.pos_counts.get(w, 0) + 1
-                else:
-                    self.neg_counts[w] = self.neg_counts.get(w, 0) + 1
-
-    def compute_likelihood(self):
-        self.effective_words = [k for k, v in self.word_counts.iteritems() if
-                                v > 1 and len(k) > 1 and not k[0].isdigit() and k not in stop_words]
-        vocab_size = len(self.effective_words)
-        for w in self.effective_words:
-            self.pos_likelihood[w] = math.log(
-                float(self.pos_counts.get(w, 0) + 1) / (self.word_counts.get(w, 0) + vocab_size))
-            self.neg_likelihood[w] = math.log(
-                float(self.neg_counts.get(w, 0) + 1) / (self.word_counts.get(w, 0) + vocab_size))
+class Classifier(NaiveBayes):
+    task = 'sentiment'
 
-    def classify(self, text):
-        pos_prob = self.prior[1]
-        neg_prob = self.prior[0]
-        for w in text_to_sequence(text):
-            pos_prob += self.pos_likelihood.get(w, 0)
-            neg_prob += self.neg_likelihood.get(w, 0)
-        return 1 if pos_prob >= neg_prob else 0
+    def __init__(self, tokenizer=None):
+        """
+        Naive Bayes sentiment classifier, label 1 for positive and 0 for negative
 
-    def compute_prior(self):
-        self.prior[0] = math.log(float(self.doc_counts[0]) / (self.doc_counts[0] + self.doc_counts[1]))
-        self.prior[1] = math.log(float(self.doc_counts[1]) / (self.doc_counts[0] + self.doc_counts[1]))
+        :param tokenizer: Tokenizer shared with other classifiers, by default a new one dropping the stop words
+        """
+        NaiveBayes.__init__(self, tokenizer, stop_words)
 
 
 stop_words = frozenset([
@@ -123,39 +73,102 @@ stop_words = frozenset([
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('--pos', metavar='FILE', help='positive data file', type=str, required=True)
-    parser.add_argument('--neg', metavar='FILE', help='negative data file', type=str, required=True)
+    parser.add_argument('--pos', metavar='FILE', help='positive data file', type=str)
+    parser.add_argument('--neg', metavar='FILE', help='negative data file', type=str)
     parser.add_argument('--test', metavar='FILE', help='test data file', type=str)
     parser.add_argument('--k', metavar='SIZE', help='k-fold size', default=0, type=int, required=False)
+    parser.add_argument('--seed', metavar='SEED', help='random seed of the k-fold split and --sample', default=0,
+                        type=int)
+    parser.add_argument('--sample', metavar='N', help='train on a random sample of N documents of each label',
+                        type=int)
+    parser.add_argument('--model', metavar='FILE', help='load the model from a file instead of training it', type=str)
+    parser.add_argument('--save', metavar='FILE', help='save the trained model to a file', type=str)
+    parser.add_argument('--sweep', help='with --k, rank the accuracy of a grid of smoothing alphas and word filters',
+                        action='store_true')
+    parser.add_argument('--alphas', metavar='LIST', help='comma separated smoothing alphas of --sweep', type=str)
+    parser.add_argument('--min-counts', metavar='LIST', help='comma separated min word counts of --sweep', type=str)
+    parser.add_argument('--min-lengths', metavar='LIST', help='comma separated min word lengths of --sweep', type=str)
+    parser.add_argument('--top', metavar='N', help='print the N best settings of --sweep', type=int)
+    instrument.add_arguments(parser)
     args = parser.parse_args()
+    instrument.start(args)
+    if args.model is None and (args.pos is None or args.neg is None):
+        parser.error('--pos and --neg are required unless --model is given')
+    if args.sweep and args.k < 2:
+        parser.error('--sweep needs --k')
+    if args.alphas and any(alpha <= 0 for alpha in parse_values(args.alphas)):
+        parser.error('--alphas must be positive')
+    if args.k != 0 and (args.model is not None or args.save is not None or args.sample is not None):
+        parser.error('--model, --save and --sample can not be used with --k or --sweep')
 
     classifier = Classifier()
     error_count, test_count = 0, 0
-    if args.k != 0:
-        pos_set = load_dataset(args.pos, label=1, k=args.k)
-        neg_set = load_dataset(args.neg, label=0, k=args.k)
-        for ii in range(args.k):
-            classifier.clear()
-            pos_train_set, pos_dev_set = pos_set.next()
-            neg_train_set, neg_dev_set = neg_set.next()
-            classifier.fit_on_texts(pos_train_set)
-            classifier.fit_on_texts(neg_train_set)
+    if args.sweep:
+        # Tokenize the data once without filters, then score every setting of the grid on each fold
+        tokenizer = sweep_tokenizer()
+        labels, folds = [], []
+
+        def sequences():
+            for mid, text, label in read_dataset(args.pos, args.neg):
+                labels.append(label)
+                folds.append(fold_of(mid, args.k, args.seed))
+                yield tokenizer.ids(text)
+
+        with instrument.phase('train'):
+            x = count_matrix(sequences())
+        labels, folds = numpy.array(labels), numpy.array(folds)
+        sweep = NaiveBayesSweep(tokenizer.words, stop_words,
+                                parse_values(args.alphas) if args.alphas else None,
+                                parse_values(args.min_counts, int) if args.min_counts else None,
+                                parse_values(args.min_lengths, int) if args.min_lengths else None)
+        with instrument.phase('sweep', calls=args.k):
+            for ii in range(args.k):
+                dev = folds == ii
+                sweep.add_fold(x[~dev], labels[~dev], x[dev], labels[dev])
+        sweep.print_results(args.top)
+    elif args.k != 0:
+        # Train on all the data once, then get each fold by removing its dev set. Folds are assigned by
+        # hashing the document ids, so the data files are streamed and never held in memory.
+        with instrument.phase('train'):
+            classifier.fit_on_texts(read_dataset(args.pos, args.neg))
+        with instrument.phase('likelihood'):
             classifier.compute_prior()
             classifier.compute_likelihood()
-            test_count += len(pos_dev_set) + len(neg_dev_set)
-            for mid, t, l in pos_dev_set:
-                error_count += 1 - classifier.classify(t)
-            for mid, t, l in neg_dev_set:
-                error_count += classifier.classify(t)
+        full_model = classifier.snapshot()
+        for ii in range(args.k):
+            if ii > 0:
+                classifier.restore(full_model)
+            with instrument.phase('unlearn'):
+                classifier.unlearn(split_records(read_dataset(args.pos, args.neg), args.k, ii, args.seed, dev=True))
+            for dev_set in chunks(split_records(read_dataset(args.pos, args.neg), args.k, ii, args.seed, dev=True),
+                                  1000):
+                with instrument.phase('inference', calls=len(dev_set)):
+                    predictions = classifier.classify_batch([t for mid, t, l in dev_set])
+                with instrument.phase('evaluate', calls=len(dev_set)):
+                    test_count += len(dev_set)
+                    error_count += sum(abs(p - l) for p, (mid, t, l) in zip(predictions, dev_set))
         print(1 - float(error_count) / test_count)
     else:
-        pos_set = load_dataset(args.pos, label=1)
-        neg_set = load_dataset(args.neg, label=0)
-        classifier.fit_on_texts(pos_set.next())
-        classifier.fit_on_texts(neg_set.next())
-        classifier.compute_prior()
-        classifier.compute_likelihood()
+        if args.model is not None:
+            with instrument.phase('model_load'):
+                classifier.load(args.model)
+        else:
+            with instrument.phase('train'):
+                if args.sample is not None:
+                    rng = random.Random(args.seed)
+                    classifier.fit_on_texts(reservoir_sample(read_records(args.pos, label=1), args.sample, rng))
+                    classifier.fit_on_texts(reservoir_sample(read_records(args.neg, label=0), args.sample, rng))
+                else:
+                    classifier.fit_on_texts(read_dataset(args.pos, args.neg))
+            with instrument.phase('likelihood'):
+                classifier.compute_prior()
+                classifier.compute_likelihood()
+            if args.save is not None:
+                classifier.save(args.save)
         if args.test is not None:
-            test_set = load_dataset(args.test).next()
-            for mid, t, l in test_set:
-                print('%s\t%s' % (mid, 'POS' if classifier.classify(t) == 1 else 'NEG'))
+            for test_set in chunks(read_records(args.test), 1000):
+                with instrument.phase('inference', calls=len(test_set)):
+                    predictions = classifier.classify_batch([t for mid, t, l in test_set])
+                for (mid, t, l), p in zip(test_set, predictions):
+                    print('%s\t%s' % (mid, 'POS' if p == 1 else 'NEG'))
+    instrument.finish(args, 'classify')
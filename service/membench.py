@@ -0,0 +1,140 @@
+__author__ = 'Jianxiang Fan'
+__email__ = 'jianxiang.fan@colorado.edu'
+
+import argparse
+import gc
+import json
+import os
+import resource
+import subprocess
+import sys
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+for d in ('sentiment', 'deception', 'segmentation'):
+    sys.path.insert(0, os.path.join(root, d))
+sys.path.insert(0, root)
+from common.dataset import read_records
+
+# Models measured by default, each of them built in its own process
+model_names = ['segmenter', 'segmenter-trie', 'segmenter-viterbi', 'sentiment', 'deception']
+
+
+def rss_kb():
+    """
+    Return the resident set size of this process, or its peak where /proc is not available
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() // 1024
+    except IOError:
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def build_model(name, args):
+    """
+    Build a model as the service does and return it with its inputs, the inputs being read first
+    so that their memory is not counted as the model's
+
+    :param name: Model name
+    :param args: Parsed arguments
+    """
+    if name.startswith('segmenter'):
+        import seg
+        if args.cache:
+            lex, counts, split_words, short_words = seg.cached_lexicon(args.lexicon, args.cache, args.limit,
+                                                                       args.core, args.st, args.sw)
+        else:
+            lex, counts, split_words, short_words = seg.read_lexicon(args.lexicon, args.limit, args.st, args.sw)
+        gc.collect()
+        before = rss_kb()
+        model = seg.Segmenter(lex,
+                              split_words=split_words,
+                              short_words=short_words,
+                              core_lexicon=lex[:args.core],
+                              use_trie=name == 'segmenter-trie',
+                              counts=counts if name == 'segmenter-viterbi' else None)
+        return model, before
+    if name == 'sentiment':
+        import classify as module
+        files = (args.pos, args.neg)
+    else:
+        import detect as module
+        files = (args.true, args.false)
+    before = rss_kb()
+    model = module.Classifier()
+    model.fit_on_texts(read_records(files[0], label=1))
+    model.fit_on_texts(read_records(files[1], label=0))
+    model.compute_prior()
+    model.compute_likelihood()
+    return model, before
+
+
+def run_model(name, args):
+    """
+    Return the resident memory before and after building a model, and the peak of the process
+
+    :param name: Model name
+    :param args: Parsed arguments
+    """
+    model, before = build_model(name, args)
+    gc.collect()
+    after = rss_kb()
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {'model': name, 'before_kb': before, 'after_kb': after, 'model_kb': after - before,
+            'peak_rss_kb': peak // 1024 if sys.platform == 'darwin' else peak}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--models', metavar='NAMES', help='comma separated models: %s' % ', '.join(model_names),
+                        default=','.join(model_names), type=str)
+    parser.add_argument('--lexicon', metavar='FILE', help='lexicon file of the segmenter',
+                        default=os.path.join(root, 'segmentation', 'data', 'bigwordlist.txt.gz'), type=str)
+    parser.add_argument('--limit', metavar='SIZE', help='limit size of the lexicon', default=75000, type=int)
+    parser.add_argument('--core', metavar='SIZE', help='limit size of the core lexicon', default=2000, type=int)
+    parser.add_argument('--cache', metavar='DIR', help='directory of compiled lexicon files', type=str)
+    parser.add_argument('--sw', help='short word check', action='store_true')
+    parser.add_argument('--st', help='split combine tokens', action='store_true')
+    parser.add_argument('--pos', metavar='FILE', help='positive data file of the sentiment model',
+                        default=os.path.join(root, 'sentiment', 'data', 'hotelPosT-train.txt'), type=str)
+    parser.add_argument('--neg', metavar='FILE', help='negative data file of the sentiment model',
+                        default=os.path.join(root, 'sentiment', 'data', 'hotelNegT-train.txt'), type=str)
+    parser.add_argument('--true', metavar='FILE', help='true data file of the deception model',
+                        default=os.path.join(root, 'deception', 'data', 'hotelT-train.txt'), type=str)
+    parser.add_argument('--false', metavar='FILE', help='false data file of the deception model',
+                        default=os.path.join(root, 'deception', 'data', 'hotelF-train.txt'), type=str)
+    parser.add_argument('--output', metavar='FILE', help='JSON result file', type=str)
+    parser.add_argument('--baseline', metavar='FILE', help='JSON result file of a baseline run to compare with',
+                        type=str)
+    parser.add_argument('--run', help=argparse.SUPPRESS, type=str)
+    args = parser.parse_args()
+
+    if args.run:
+        # Measure a single model in this process, so that the memory is its own
+        print(json.dumps(run_model(args.run, args)))
+        sys.exit(0)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = dict((r['model'], r) for r in json.load(f))
+    options = ['--lexicon', args.lexicon, '--limit', str(args.limit), '--core', str(args.core), '--pos', args.pos,
+               '--neg', args.neg, '--true', args.true, '--false', args.false]
+    options += (['--cache', args.cache] if args.cache else []) + (['--sw'] if args.sw else []) + (
+        ['--st'] if args.st else [])
+    results = []
+    for name in args.models.split(','):
+        output = subprocess.check_output([sys.executable, sys.argv[0], '--run', name] + options)
+        r = json.loads(output.decode('utf-8'))
+        results.append(r)
+        line = '%-18s model %8d KB  rss %8d KB  peak %8d KB' % (name, r['model_kb'], r['after_kb'], r['peak_rss_kb'])
+        b = baseline.get(name)
+        if b is not None:
+            line += '  baseline model %8d KB (%+.1f%%)' % (
+                b['model_kb'], 100.0 * (r['model_kb'] - b['model_kb']) / b['model_kb'] if b['model_kb'] else 0.0)
+        print(line)
+        sys.stdout.flush()
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
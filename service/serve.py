@@ -0,0 +1,284 @@
+__author__ = 'Jianxiang Fan'
+__email__ = 'jianxiang.fan@colorado.edu'
+
+import argparse
+import BaseHTTPServer
+import Queue
+import SocketServer
+import collections
+import json
+import os
+import sys
+import threading
+import time
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+for d in ('sentiment', 'deception', 'segmentation'):
+    sys.path.insert(0, os.path.join(root, d))
+import classify
+import detect
+import seg
+
+
+class Metrics(object):
+    def __init__(self, window=10000):
+        """
+        Count the requests of a model and keep the latencies of the last ones
+
+        :param window: Number of latencies kept for the percentiles
+        """
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=window)
+        self.counts = dict.fromkeys(['requests', 'texts', 'batches', 'rejected', 'errors'], 0)
+        self.busy_seconds = 0.0
+
+    def add_request(self, latency, error=False):
+        with self.lock:
+            self.latencies.append(latency)
+            self.counts['requests'] += 1
+            if error:
+                self.counts['errors'] += 1
+
+    def add_batch(self, texts, seconds):
+        with self.lock:
+            self.counts['batches'] += 1
+            self.counts['texts'] += texts
+            self.busy_seconds += seconds
+
+    def add_rejected(self):
+        with self.lock:
+            self.counts['rejected'] += 1
+
+    def report(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            result = dict(self.counts)
+            result['busy_seconds'] = self.busy_seconds
+        result['mean_batch_texts'] = float(result['texts']) / result['batches'] if result['batches'] else 0.0
+        for name, q in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99)):
+            result['latency_%s_ms' % name] = latencies[int(q * (len(latencies) - 1))] * 1000 if latencies else 0.0
+        return result
+
+
+class Request(object):
+    def __init__(self, texts):
+        self.texts = texts
+        self.start = time.time()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Batcher(object):
+    def __init__(self, predict, max_batch=256, max_delay=0.002, max_pending=1024):
+        """
+        Run the requests of a model in micro-batches on a worker thread. A batch takes the requests
+        waiting in the queue, and those arriving within max_delay, up to max_batch texts. The queue is
+        bounded: when max_pending requests are waiting, submit fails at once instead of queueing more work.
+
+        :param predict: Function from a list of texts to the list of their results
+        :param max_batch: Max number of texts of a batch, unless a single request has more
+        :param max_delay: Max seconds to wait for more requests after the first one of a batch
+        :param max_pending: Max number of waiting requests
+        """
+        self.predict = predict
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queue = Queue.Queue(max_pending)
+        self.metrics = Metrics()
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def submit(self, texts):
+        """
+        Wait for the results of the texts. Raise Queue.Full if too many requests are waiting, or
+        RuntimeError if the prediction failed.
+
+        :param texts: List of texts
+        """
+        request = Request(texts)
+        try:
+            self.queue.put_nowait(request)
+        except Queue.Full:
+            self.metrics.add_rejected()
+            raise
+        request.done.wait()
+        self.metrics.add_request(time.time() - request.start, request.error is not None)
+        if request.error is not None:
+            raise RuntimeError(request.error)
+        return request.result
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            size = len(batch[0].texts)
+            deadline = time.time() + self.max_delay
+            while size < self.max_batch:
+                try:
+                    request = self.queue.get(timeout=max(deadline - time.time(), 0))
+                except Queue.Empty:
+                    break
+                batch.append(request)
+                size += len(request.texts)
+            start = time.time()
+            try:
+                results, error = self.predict([t for r in batch for t in r.texts]), None
+            except Exception as e:
+                results, error = None, '%s: %s' % (type(e).__name__, e)
+            self.metrics.add_batch(size, time.time() - start)
+            offset = 0
+            for r in batch:
+                if error is None:
+                    r.result = results[offset:offset + len(r.texts)]
+                else:
+                    r.error = error
+                offset += len(r.texts)
+                r.done.set()
+
+
+def classifier_predict(classifier, labels):
+    """
+    Return a predict function giving the label and the log posterior ratio of each text
+
+    :param classifier: Trained classifier
+    :param labels: Names of label 0 and label 1
+    """
+
+    def predict(texts):
+        scores = classifier.score_matrix(classifier.texts_to_matrix(texts)).tolist()
+        return [{'label': labels[int(s >= 0)], 'score': s} for s in scores]
+
+    return predict
+
+
+def segmenter_predict(segmenter, base):
+    """
+    Return a predict function giving the words of each text. The segmenter works on bytes, so the
+    words splitting a multi-byte character are decoded with replacement characters.
+
+    :param segmenter: Segmenter
+    :param base: Segmentation mode
+    """
+
+    def predict(texts):
+        return [{'words': [w.decode('utf-8', 'replace') for w in segmenter.match(seg.clean_input(t), base)]}
+                for t in texts]
+
+    return predict
+
+
+class ServiceHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    POST /<model> with {"texts": [...]} returns {"results": [...]}, GET /metrics returns the metrics of
+    every model
+    """
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            return self.reply(404, {'error': 'unknown path %s' % self.path})
+        self.reply(200, dict((name, b.metrics.report()) for name, b in self.server.batchers.items()))
+
+    def do_POST(self):
+        batcher = self.server.batchers.get(self.path.strip('/'))
+        if batcher is None:
+            return self.reply(404, {'error': 'unknown model %s' % self.path.strip('/')})
+        try:
+            texts = json.loads(self.rfile.read(int(self.headers.getheader('Content-Length', 0))))['texts']
+            if not isinstance(texts, list) or not all(isinstance(t, basestring) for t in texts):
+                raise TypeError('texts is not a list of strings')
+        except (ValueError, KeyError, TypeError) as e:
+            return self.reply(400, {'error': 'bad request: %s' % e})
+        try:
+            results = batcher.submit([t.encode('utf-8') if isinstance(t, unicode) else t for t in texts])
+        except Queue.Full:
+            return self.reply(503, {'error': 'too many pending requests'}, {'Retry-After': '1'})
+        except RuntimeError as e:
+            return self.reply(500, {'error': str(e)})
+        self.reply(200, {'results': results})
+
+    def reply(self, code, body, headers=None):
+        data = json.dumps(body)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, batchers, verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, ServiceHandler)
+        self.batchers = batchers
+        self.verbose = verbose
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', metavar='HOST', help='address to listen on', default='127.0.0.1', type=str)
+    parser.add_argument('--port', metavar='PORT', help='port to listen on', default=8080, type=int)
+    parser.add_argument('--sentiment', metavar='FILE', help='sentiment model saved by classify.py --save', type=str)
+    parser.add_argument('--deception', metavar='FILE', help='deception model saved by detect.py --save', type=str)
+    parser.add_argument('--lexicon', metavar='FILE', help='lexicon file of the segmenter', type=str)
+    parser.add_argument('--limit', metavar='SIZE', help='limit size of the lexicon', default=75000, type=int)
+    parser.add_argument('--core', metavar='SIZE', help='limit size of the core lexicon', default=2000, type=int)
+    parser.add_argument('--cache', metavar='DIR', help='directory of compiled lexicon files', type=str)
+    parser.add_argument('--mode', metavar='MODE', help='segmentation mode: %s' % ', '.join(seg.base_modes),
+                        default='front', choices=seg.base_modes, type=str)
+    parser.add_argument('--sw', help='short word check', action='store_true')
+    parser.add_argument('--st', help='split combine tokens', action='store_true')
+    parser.add_argument('--memo', metavar='SIZE', help='cache up to SIZE segmentation results', type=int)
+    parser.add_argument('--max-batch', metavar='N', help='max texts of a batch', default=256, type=int)
+    parser.add_argument('--max-delay', metavar='MS', help='max milliseconds to wait to fill a batch',
+                        default=2.0, type=float)
+    parser.add_argument('--max-pending', metavar='N', help='max waiting requests of a model, more are rejected',
+                        default=1024, type=int)
+    parser.add_argument('--verbose', help='log every request', action='store_true')
+    args = parser.parse_args()
+
+    predicts = {}
+    if args.sentiment:
+        sentiment = classify.Classifier()
+        sentiment.load(args.sentiment)
+        predicts['sentiment'] = classifier_predict(sentiment, ['NEG', 'POS'])
+    if args.deception:
+        deception = detect.Classifier()
+        deception.load(args.deception)
+        predicts['deception'] = classifier_predict(deception, ['F', 'T'])
+    if args.lexicon:
+        if args.cache:
+            lex, counts, split_words, short_words = seg.cached_lexicon(args.lexicon, args.cache, args.limit,
+                                                                       args.core, args.st, args.sw)
+        else:
+            lex, counts, split_words, short_words = seg.read_lexicon(args.lexicon, args.limit, args.st, args.sw)
+        if args.mode == 'viterbi' and counts is None:
+            parser.error('viterbi mode needs a lexicon with counts')
+        segmenter = seg.Segmenter(lex,
+                                  split_words=split_words,
+                                  short_words=short_words,
+                                  core_lexicon=lex[:args.core],
+                                  counts=counts if args.mode == 'viterbi' else None,
+                                  cache=seg.MatchCache(args.memo) if args.memo else None)
+        predicts['segment'] = segmenter_predict(segmenter, args.mode)
+    if not predicts:
+        parser.error('no model to serve, give --sentiment, --deception or --lexicon')
+
+    batchers = dict((name, Batcher(predict, args.max_batch, args.max_delay / 1000, args.max_pending))
+                    for name, predict in predicts.items())
+    server = Server((args.host, args.port), batchers, args.verbose)
+    sys.stderr.write('serving %s on %s:%d\n' % (', '.join(sorted(batchers)), args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()